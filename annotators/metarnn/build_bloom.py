@@ -0,0 +1,38 @@
+"""
+Builds the Bloom filter of the MetaRNN database which ships with this module.
+
+    python build_bloom.py data/metarnn.sqlite [false_positive_rate]
+
+Every chrom:pos:ref:alt key of the chromosome tables is added to a filter
+sized for the given false positive rate, 0.01 by default, which is written
+to data/metarnn.bloom. At 0.01, the filter takes about 1.2 bytes per key.
+"""
+import sys
+import sqlite3
+from pathlib import Path
+from build_index import load_annotator_module
+
+
+def build_bloom(db_path: str, false_positive_rate: float = 0.01):
+    module = load_annotator_module()
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {v[0] for v in cursor.fetchall()}
+    chroms = [chrom for chrom in module.Annotator.valid_chroms if chrom in tables]
+    num_keys = 0
+    for chrom in chroms:
+        cursor.execute(f"SELECT COUNT(*) FROM {chrom}")
+        num_keys += cursor.fetchone()[0]
+    bloom = module.BloomFilter.create(num_keys, false_positive_rate)
+    for chrom in chroms:
+        cursor.execute(f"SELECT pos, ref, alt FROM {chrom}")
+        for pos, ref, alt in cursor:
+            bloom.add(chrom, pos, ref, alt)
+    conn.close()
+    bloom.save(Path(db_path).parent / module.BLOOM_FILE_NAME)
+    print(f"{num_keys} keys, {bloom.num_bits} bits, {bloom.num_hashes} hashes")
+
+
+if __name__ == "__main__":
+    build_bloom(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 0.01)
@@ -0,0 +1,95 @@
+"""
+Builds the sorted-array index of the MetaRNN database which ships with this
+module.
+
+    python build_index.py data/metarnn.sqlite
+
+For each chromosome table, data/index/<chrom>.keys.npy holds the packed
+pos << 4 | ref << 2 | alt keys of its rows in ascending order, and
+<chrom>.values.bin the transcript, score, rankscore and pred of each key,
+at the byte offsets in <chrom>.offsets.npy. The all_info transcripts of
+each key are parsed into <chrom>.info_*.npy arrays: transcript numbers into
+data/index/transcripts.txt, which lists each transcript ID once, score and
+rankscore as uint32 fixed-point numbers (the score times 10 ** 9), and pred
+as a uint8 code, with the range of each key in <chrom>.info_offsets.npy. If a key has more than one row, the first one
+in the table is kept, as with fetchone in the SQLite query. Rows which are
+not A, C, G or T SNVs are left out. NumPy is needed.
+"""
+import sys
+import sqlite3
+import importlib.util
+from pathlib import Path
+import numpy as np
+
+
+def load_annotator_module():
+    script_path = Path(__file__).parent / "metarnn.py"
+    spec = importlib.util.spec_from_file_location("metarnn", script_path)
+    if spec is None or spec.loader is None:
+        raise Exception(f"{script_path} could not be loaded.")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_chrom(cursor: sqlite3.Cursor, chrom: str, index_dir: Path, module, transcripts: dict) -> int:
+    keys = []
+    values = []
+    infos = []
+    cursor.execute(f"SELECT pos, ref, alt, {', '.join(module.VALUE_COLUMNS)} FROM {chrom} ORDER BY rowid")
+    for row in cursor:
+        key = module.pack_key(row[0], row[1], row[2])
+        if key is None:
+            continue
+        keys.append(key)
+        values.append(module.encode_row(row[3:7]))
+        infos.append(module.parse_all_info(row[7]))
+    keys = np.array(keys, dtype=np.uint64)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    order = order[first]
+    keys = keys[first]
+    offsets = np.zeros(len(keys) + 1, dtype=np.uint64)
+    info_offsets = np.zeros(len(keys) + 1, dtype=np.uint64)
+    info = {"transcripts": [], "scores": [], "rankscores": [], "preds": []}
+    with open(index_dir / f"{chrom}.values.bin", "wb") as wf:
+        for i, row in enumerate(order):
+            wf.write(values[row])
+            offsets[i + 1] = offsets[i] + len(values[row])
+            for transcript, score, rankscore, pred in infos[row]:
+                info["transcripts"].append(transcripts.setdefault(transcript, len(transcripts)))
+                info["scores"].append(module.encode_score(score))
+                info["rankscores"].append(module.encode_score(rankscore))
+                info["preds"].append(module.PRED_CODES.get(pred, 0))
+            info_offsets[i + 1] = len(info["transcripts"])
+    np.save(index_dir / f"{chrom}.keys.npy", keys)
+    np.save(index_dir / f"{chrom}.offsets.npy", offsets)
+    np.save(index_dir / f"{chrom}.info_offsets.npy", info_offsets)
+    np.save(index_dir / f"{chrom}.info_transcripts.npy", np.array(info["transcripts"], dtype=np.uint32))
+    np.save(index_dir / f"{chrom}.info_scores.npy", np.array(info["scores"], dtype=np.uint32))
+    np.save(index_dir / f"{chrom}.info_rankscores.npy", np.array(info["rankscores"], dtype=np.uint32))
+    np.save(index_dir / f"{chrom}.info_preds.npy", np.array(info["preds"], dtype=np.uint8))
+    return len(keys)
+
+
+def build_index(db_path: str):
+    module = load_annotator_module()
+    index_dir = Path(db_path).parent / module.INDEX_DIR_NAME
+    index_dir.mkdir(exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {v[0] for v in cursor.fetchall()}
+    transcripts = {}
+    for chrom in module.Annotator.valid_chroms:
+        if chrom in tables:
+            print(f"{chrom}\t{build_chrom(cursor, chrom, index_dir, module, transcripts)}")
+    conn.close()
+    with open(index_dir / module.TRANSCRIPTS_FILE_NAME, "w") as wf:
+        wf.write("\n".join(transcripts))
+
+
+if __name__ == "__main__":
+    build_index(sys.argv[1])
@@ -1,4 +1,279 @@
+import ast
+import json
+import mmap
+import math
+import struct
+import sys
+from hashlib import blake2b
+from pathlib import Path
+from typing import Dict, List, Optional
 from oakvar import BaseAnnotator
+from oakvar.lib.util.run import get_standardized_module_option
+
+BASE_CODES = {"A": 0, "C": 1, "G": 2, "T": 3}
+INDEX_DIR_NAME = "index"
+VALUE_COLUMNS = ["transcript", "score", "rankscore", "pred", "all_info"]
+# Columns kept as encoded rows in <chrom>.values.bin. all_info is stored as
+# typed arrays.
+ROW_COLUMNS = VALUE_COLUMNS[:-1]
+TRANSCRIPTS_FILE_NAME = "transcripts.txt"
+PRED_CODES = {"T": 1, "D": 2}
+# Scores and rank-scores of all_info are stored as uint32 fixed-point numbers,
+# the score times SCORE_SCALE, which keeps the up to 9 decimals of dbNSFP.
+SCORE_SCALE = 10 ** 9
+MISSING_SCORE = 0xFFFFFFFF
+PREDS = [None, "T", "D"]
+FIELD_SEPARATOR = "\t"
+BLOOM_FILE_NAME = "metarnn.bloom"
+BLOOM_MAGIC = b"MRBF"
+BLOOM_HEADER = struct.Struct("<4sIQ")
+BATCH_TABLE_QUERY = """
+    CREATE TEMP TABLE IF NOT EXISTS batch_variant
+    (chrom TEXT, pos INTEGER, ref TEXT, alt TEXT, input_index INTEGER)
+"""
+BATCH_JOIN_QUERY = """
+    SELECT b.input_index, t.transcript, t.score, t.rankscore, t.pred, t.all_info
+    FROM temp.batch_variant AS b
+    JOIN {chrom} AS t ON t.pos = b.pos AND t.ref = b.ref AND t.alt = b.alt
+    WHERE b.chrom = ?
+    ORDER BY b.rowid, t.rowid
+"""
+# Variants annotated together by process_file
+BATCH_SIZE = 10000
+# Counts of the prefilter and the Bloom filter, logged at cleanup
+COUNTER_NAMES = ["num_checked", "num_passed", "num_found", "num_skipped_allele", "num_skipped_so"]
+# Consequences of the nonsynonymous SNVs which MetaRNN scores
+CODING_SO = ["missense_variant", "start_lost", "stop_gained", "stop_lost"]
+
+
+def pack_key(pos, ref: str, alt: str) -> Optional[int]:
+    """
+    Packs a SNV into one integer, pos << 4 | ref << 2 | alt, with the bases
+    coded as A=0, C=1, G=2 and T=3. Returns None for any other allele.
+    """
+    ref_code = BASE_CODES.get(ref)
+    alt_code = BASE_CODES.get(alt)
+    if ref_code is None or alt_code is None:
+        return None
+    return (int(pos) << 4) | (ref_code << 2) | alt_code
+
+
+def encode_row(row) -> bytes:
+    return FIELD_SEPARATOR.join("" if v is None else str(v) for v in row).encode()
+
+
+def decode_row(value: bytes) -> Dict[str, Optional[str]]:
+    fields = value.decode().split(FIELD_SEPARATOR, len(ROW_COLUMNS) - 1)
+    return {col: field or None for col, field in zip(ROW_COLUMNS, fields)}
+
+
+def parse_all_info(value: Optional[str]) -> List[list]:
+    """
+    Parses the all_info text of the database, a nested list of transcript,
+    score, rankscore and pred, into a list of lists.
+    """
+    if not value:
+        return []
+    try:
+        return json.loads(value.replace("'", '"'))
+    except ValueError:
+        return ast.literal_eval(value)
+
+
+def encode_score(value) -> int:
+    """
+    Returns a score of all_info as a fixed-point number, or MISSING_SCORE
+    if it is missing or not a number.
+    """
+    try:
+        score = round(float(value) * SCORE_SCALE)
+    except (TypeError, ValueError, OverflowError):
+        return MISSING_SCORE
+    if not 0 <= score < MISSING_SCORE:
+        raise ValueError(f"{value} is out of the range of fixed-point scores.")
+    return score
+
+
+def format_score(value: int) -> Optional[str]:
+    """
+    Formats a fixed-point score with the fewest digits which read back to
+    it, which gives the text of the database for scores of up to 9
+    decimals. MISSING_SCORE gives None.
+    """
+    if value == MISSING_SCORE:
+        return None
+    return str(value / SCORE_SCALE)
+
+
+class ChromIndex:
+    """
+    The index of one chromosome table: the sorted packed keys of its rows in
+    <chrom>.keys.npy, and their output columns as encoded rows in
+    <chrom>.values.bin, the row of keys[i] being
+    values[offsets[i]:offsets[i + 1]]. The all_info transcripts of keys[i]
+    are entries info_offsets[i] to info_offsets[i + 1] of the
+    <chrom>.info_*.npy arrays: the transcript number in transcripts.txt,
+    score and rankscore as uint32 fixed-point numbers, and pred as a uint8
+    code. All of them are memory-mapped.
+    """
+
+    def __init__(self, index_dir: Path, chrom: str):
+        import numpy as np
+
+        # Plain ndarray views of the maps, as slicing an np.memmap is slower.
+        self.keys = np.asarray(np.load(index_dir / f"{chrom}.keys.npy", mmap_mode="r"))
+        self.offsets = np.asarray(np.load(index_dir / f"{chrom}.offsets.npy", mmap_mode="r"))
+        values_path = index_dir / f"{chrom}.values.bin"
+        if values_path.stat().st_size:
+            self.values = np.asarray(np.memmap(values_path, dtype=np.uint8, mode="r"))
+        else:
+            self.values = np.zeros(0, dtype=np.uint8)
+        self.info = {
+            name: np.asarray(np.load(index_dir / f"{chrom}.info_{name}.npy", mmap_mode="r"))
+            for name in ["offsets", "transcripts", "scores", "rankscores", "preds"]
+        }
+
+    def find(self, keys) -> List[int]:
+        """
+        Returns the row number of each of the given packed keys, or -1 for a
+        key which is not in the index.
+        """
+        import numpy as np
+
+        keys = np.asarray(keys, dtype=np.uint64)
+        if not len(self.keys) or not len(keys):
+            return [-1] * len(keys)
+        rows = np.searchsorted(self.keys, keys)
+        clipped = np.minimum(rows, len(self.keys) - 1)
+        found = self.keys[clipped] == keys
+        return np.where(found, clipped, -1).tolist()
+
+    def get_row(self, row: int) -> Dict[str, Optional[str]]:
+        start, end = self.offsets[row : row + 2].tolist()
+        return decode_row(self.values[start:end].tobytes())
+
+    def get_all_info(self, row: int, transcripts: List[str]) -> List[list]:
+        start, end = self.info["offsets"][row : row + 2].tolist()
+        return [
+            [transcripts[transcript], format_score(score), format_score(rankscore), PREDS[pred]]
+            for transcript, score, rankscore, pred in zip(
+                self.info["transcripts"][start:end].tolist(),
+                self.info["scores"][start:end].tolist(),
+                self.info["rankscores"][start:end].tolist(),
+                self.info["preds"][start:end].tolist(),
+            )
+        ]
+
+
+class MetaRNNIndex:
+    """
+    Per-chromosome sorted-array index of the MetaRNN database, written by
+    build_index.py into data/index. A chromosome's arrays are mapped when it
+    is first looked up, and a chromosome without index files has no hits.
+    The transcript IDs of all_info are read when all_info is first decoded.
+    """
+
+    def __init__(self, index_dir: Path):
+        self.index_dir = index_dir
+        self.chroms: Dict[str, Optional[ChromIndex]] = {}
+        self.transcripts: Optional[List[str]] = None
+
+    def get_transcripts(self) -> List[str]:
+        if self.transcripts is None:
+            with open(self.index_dir / TRANSCRIPTS_FILE_NAME) as f:
+                self.transcripts = [sys.intern(v) for v in f.read().split("\n")]
+        return self.transcripts
+
+    @classmethod
+    def load(cls, index_dir: Path) -> Optional["MetaRNNIndex"]:
+        if not index_dir.is_dir():
+            return None
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            return None
+        return cls(index_dir)
+
+    def get_chrom(self, chrom: str) -> Optional[ChromIndex]:
+        if chrom not in self.chroms:
+            if (self.index_dir / f"{chrom}.keys.npy").exists():
+                self.chroms[chrom] = ChromIndex(self.index_dir, chrom)
+            else:
+                self.chroms[chrom] = None
+        return self.chroms[chrom]
+
+    def lookup(self, chrom: str, keys: List[int], all_info: bool = True) -> List[Optional[dict]]:
+        """
+        Returns the output of each of the given packed keys, or None for a
+        key which is not in the index. all_info is decoded only if all_info
+        is True.
+        """
+        chrom_index = self.get_chrom(chrom)
+        if chrom_index is None:
+            return [None] * len(keys)
+        outputs = []
+        for row in chrom_index.find(keys):
+            if row < 0:
+                outputs.append(None)
+                continue
+            output = chrom_index.get_row(row)
+            output["all_info"] = chrom_index.get_all_info(row, self.get_transcripts()) if all_info else None
+            outputs.append(output)
+        return outputs
+
+
+class BloomFilter:
+    """
+    Bloom filter over the chrom:pos:ref:alt keys of the MetaRNN database.
+    The bit positions of a key are h1 + i * h2 modulo the number of bits,
+    for i below the number of hashes, with h1 and h2 the two halves of its
+    blake2b digest. The file is a header of magic, number of hashes and
+    number of bits, followed by the bits, and is memory-mapped.
+    """
+
+    def __init__(self, num_bits: int, num_hashes: int, bits):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits
+
+    @classmethod
+    def create(cls, num_keys: int, false_positive_rate: float = 0.01) -> "BloomFilter":
+        num_bits = max(8, math.ceil(-num_keys * math.log(false_positive_rate) / math.log(2) ** 2))
+        num_hashes = max(1, round(num_bits / max(num_keys, 1) * math.log(2)))
+        return cls(num_bits, num_hashes, bytearray((num_bits + 7) // 8))
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["BloomFilter"]:
+        if not path.exists():
+            return None
+        with open(path, "rb") as f:
+            bits = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_hashes, num_bits = BLOOM_HEADER.unpack_from(bits)
+        if magic != BLOOM_MAGIC:
+            raise Exception(f"{path} is not a MetaRNN Bloom filter.")
+        return cls(num_bits, num_hashes, memoryview(bits)[BLOOM_HEADER.size :])
+
+    def save(self, path: Path):
+        with open(path, "wb") as wf:
+            wf.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.num_hashes, self.num_bits))
+            wf.write(self.bits)
+
+    def get_positions(self, chrom: str, pos, ref: str, alt: str):
+        digest = blake2b(f"{chrom}:{pos}:{ref}:{alt}".encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, chrom: str, pos, ref: str, alt: str):
+        for position in self.get_positions(chrom, pos, ref, alt):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def may_contain(self, chrom: str, pos, ref: str, alt: str) -> bool:
+        bits = self.bits
+        for position in self.get_positions(chrom, pos, ref, alt):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
 
 
 class Annotator(BaseAnnotator):
@@ -30,22 +305,233 @@ class Annotator(BaseAnnotator):
         "chrM",
     ]
 
+    def setup(self):
+        """
+        Loads the sorted-array index in data/index, if it was built and
+        NumPy is installed, unless the use_index option is false. Without
+        the index, variants are queried from the SQLite database, and the
+        Bloom filter in data/metarnn.bloom, if present, is mapped so that
+        variants which are not in the database are not queried. The index
+        rejects misses with its binary search, so the filter is not used
+        with it.
+        """
+        self.index = None
+        if get_standardized_module_option(self.module_options.get("use_index", "true")) == True:
+            self.index = MetaRNNIndex.load(Path(self.data_dir) / INDEX_DIR_NAME)
+        self.bloom = None
+        if self.index is None and get_standardized_module_option(self.module_options.get("use_bloom", "true")) == True:
+            self.bloom = BloomFilter.load(Path(self.data_dir) / BLOOM_FILE_NAME)
+        self.num_checked = 0
+        self.num_passed = 0
+        self.num_found = 0
+        self.prefilter = get_standardized_module_option(self.module_options.get("prefilter", "true")) == True
+        coding_so = self.module_options.get("coding_so", CODING_SO)
+        if isinstance(coding_so, str):
+            coding_so = [v.strip() for v in coding_so.split(",") if v.strip()]
+        self.coding_so = set(coding_so)
+        self.num_skipped_allele = 0
+        self.num_skipped_so = 0
+        self.all_info = get_standardized_module_option(self.module_options.get("all_info", "true")) == True
+        self.tables = set()
+        if self.cursor:
+            self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            self.tables = {v[0] for v in self.cursor.fetchall()}
+
+    def cleanup(self):
+        if not self.logger:
+            return
+        if self.prefilter:
+            self.logger.info(
+                f"Prefilter: {self.num_skipped_allele} variants skipped for not being SNVs, "
+                + f"{self.num_skipped_so} for having no consequence in {','.join(sorted(self.coding_so))}"
+            )
+        if self.bloom is None:
+            return
+        skipped = self.num_checked - self.num_passed
+        self.logger.info(
+            f"Bloom filter: {skipped} of {self.num_checked} variants skipped "
+            + f"({skipped / max(self.num_checked, 1):.1%}), "
+            + f"{self.num_found} of {self.num_passed} passed variants found "
+            + f"({self.num_found / max(self.num_passed, 1):.1%})"
+        )
+
+    def passes_prefilter(self, input_data: dict) -> bool:
+        """
+        Returns False for a variant which cannot be in MetaRNN: one which is
+        not a SNV, or one whose consequences on all transcripts are known
+        and none of them is in the coding_so option. The primary so and the
+        consequences in all_mappings are used, as MetaRNN scores every
+        transcript. A variant without consequences is kept.
+        """
+        if not self.prefilter:
+            return True
+        ref = input_data["ref_base"]
+        alt = input_data["alt_base"]
+        if len(ref) != 1 or len(alt) != 1 or ref == "-" or alt == "-":
+            self.num_skipped_allele += 1
+            return False
+        sos = set((input_data.get("so") or "").split(","))
+        mapping_parser = input_data.get("mapping_parser")
+        if mapping_parser is not None:
+            sos.update(mapping_parser.get_uniq_sos())
+        sos.discard("")
+        if sos and sos.isdisjoint(self.coding_so):
+            self.num_skipped_so += 1
+            return False
+        return True
+
+    def passes_bloom(self, chrom: str, input_data: dict) -> bool:
+        if self.bloom is None:
+            return True
+        self.num_checked += 1
+        if not self.bloom.may_contain(chrom, input_data["pos"], input_data["ref_base"], input_data["alt_base"]):
+            return False
+        self.num_passed += 1
+        return True
+
+    def process_file(self):
+        """
+        Reads the input in chunks of BATCH_SIZE variants, annotates each
+        chunk with annotate_batch and writes the outputs in input order, as
+        BaseAnnotator.process_file does one variant at a time. If a chunk
+        fails, its variants are annotated one at a time, so that the error
+        is logged for the variant which caused it.
+        """
+        chunk = []
+        for lnum, line, input_data, _ in self._get_input():
+            try:
+                self.log_progress(lnum)
+                # * allele and undefined non-canonical chroms are skipped.
+                if self.is_star_allele(input_data) or self.should_skip_chrom(input_data):
+                    continue
+            except Exception as e:
+                self.log_input_exception(lnum, line, input_data, e)
+                continue
+            chunk.append((lnum, line, input_data))
+            if len(chunk) >= BATCH_SIZE:
+                self.write_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.write_chunk(chunk)
+
+    def write_chunk(self, chunk: List[tuple]):
+        counts = [getattr(self, name) for name in COUNTER_NAMES]
+        try:
+            outputs = self.annotate_batch([input_data for _, _, input_data in chunk])
+        except Exception:
+            # The variants of a failed chunk are counted again one at a time.
+            for name, count in zip(COUNTER_NAMES, counts):
+                setattr(self, name, count)
+            outputs = None
+        for i, (lnum, line, input_data) in enumerate(chunk):
+            try:
+                output_dict = self.annotate(input_data) if outputs is None else outputs[i]
+                if output_dict is None:
+                    continue
+                output_dict = self.handle_jsondata(output_dict)
+                if output_dict:
+                    output_dict[self._id_col_name] = input_data[self._id_col_name]
+                output_dict = self.fill_empty_output(output_dict)
+                if self.output_writer:
+                    self.output_writer.write_data(output_dict)
+            except Exception as e:
+                self.log_input_exception(lnum, line, input_data, e)
+
+    def log_input_exception(self, lnum, line, input_data: dict, e: Exception):
+        fn = self.primary_input_reader.path if self.primary_input_reader else "?"
+        self._log_runtime_exception(lnum, line, input_data, e, fn=fn)
+
     def annotate(self, input_data):
-        if not self.cursor:
-            return None
         if input_data["chrom"] not in self.valid_chroms:
             return None
         chrom = input_data["chrom"]
+        if not self.passes_prefilter(input_data) or not self.passes_bloom(chrom, input_data):
+            return None
+        if self.index is not None:
+            key = pack_key(input_data["pos"], input_data["ref_base"], input_data["alt_base"])
+            output = None if key is None else self.index.lookup(chrom, [key], self.all_info)[0]
+        else:
+            output = self.query(chrom, input_data)
+        if output is not None:
+            self.num_found += 1
+        return output
+
+    def query(self, chrom: str, input_data: dict) -> Optional[dict]:
+        if not self.cursor:
+            return None
         self.cursor.execute(
             f"select transcript, score, rankscore, pred, all_info from {chrom} where pos=? and ref=? and alt=?;",
             (input_data["pos"], input_data["ref_base"], input_data["alt_base"]),
         )
         qr = self.cursor.fetchone()
         if qr is not None:
-            return {
-                "transcript": qr[0],
-                "score": qr[1],
-                "rankscore": qr[2],
-                "pred": qr[3],
-                "all_info": qr[4]
-            }
+            return self.make_output(qr)
+
+    def make_output(self, qr) -> dict:
+        return {
+            "transcript": qr[0],
+            "score": qr[1],
+            "rankscore": qr[2],
+            "pred": qr[3],
+            "all_info": parse_all_info(qr[4]) if self.all_info else None,
+        }
+
+    def annotate_batch(self, input_datas: List[dict]) -> List[Optional[dict]]:
+        """
+        Annotates a list of input_data dicts and returns their outputs in
+        the same order. With the index, the variants of each chromosome are
+        looked up with one vectorized binary search. Without it, they are
+        loaded into a temporary table sorted by chromosome and position,
+        and fetched with one join against each chromosome table.
+        """
+        outputs: List[Optional[dict]] = [None] * len(input_datas)
+        variants = []
+        for i, input_data in enumerate(input_datas):
+            chrom = input_data["chrom"]
+            if chrom not in self.valid_chroms or not self.passes_prefilter(input_data):
+                continue
+            if self.index is None and not self.passes_bloom(chrom, input_data):
+                continue
+            variants.append((chrom, int(input_data["pos"]), input_data["ref_base"], input_data["alt_base"], i))
+        if self.index is not None:
+            self.lookup_batch(variants, outputs)
+        else:
+            self.query_batch(variants, outputs)
+        return outputs
+
+    def lookup_batch(self, variants: List[tuple], outputs: List[Optional[dict]]):
+        keys_by_chrom: Dict[str, List[int]] = {}
+        indexes_by_chrom: Dict[str, List[int]] = {}
+        for chrom, pos, ref, alt, i in variants:
+            key = pack_key(pos, ref, alt)
+            if key is None:
+                continue
+            keys_by_chrom.setdefault(chrom, []).append(key)
+            indexes_by_chrom.setdefault(chrom, []).append(i)
+        for chrom, keys in keys_by_chrom.items():
+            for i, output in zip(indexes_by_chrom[chrom], self.index.lookup(chrom, keys, self.all_info)):
+                outputs[i] = output
+                if output is not None:
+                    self.num_found += 1
+
+    def query_batch(self, variants: List[tuple], outputs: List[Optional[dict]]):
+        """
+        Fetches the rows of the given (chrom, pos, ref, alt, input index)
+        variants into outputs. The join probes each chromosome table in
+        position order, and if a variant has more than one row, the first
+        one in the table is kept, as in query.
+        """
+        if not self.cursor or not variants:
+            return
+        variants.sort(key=lambda v: (v[0], v[1]))
+        self.cursor.execute(BATCH_TABLE_QUERY)
+        self.cursor.execute("DELETE FROM temp.batch_variant")
+        self.cursor.executemany("INSERT INTO temp.batch_variant VALUES (?, ?, ?, ?, ?)", variants)
+        for chrom in sorted({v[0] for v in variants}):
+            if chrom not in self.tables:
+                continue
+            self.cursor.execute(BATCH_JOIN_QUERY.format(chrom=chrom), (chrom,))
+            for input_index, *values in self.cursor.fetchall():
+                if outputs[input_index] is None:
+                    outputs[input_index] = self.make_output(values)
+                    self.num_found += 1
@@ -0,0 +1,67 @@
+"""
+Times the full-table queries which the annotator runs at setup on the PMKB
+database before and after build_indexes.py, and with the default connection
+against the read-only immutable connection of the annotator.
+
+    python benchmark.py data/pmkb.sqlite
+
+The database is copied to a temporary directory twice, one copy without
+the indexes and one with them, so the given file is not changed. For each
+query, the time per execution is printed in microseconds.
+"""
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+from build_indexes import build_indexes
+
+RULES_QUERY = "SELECT gene, achange, pmkb_url_variants FROM variant ORDER BY rowid"
+INTERPRETATIONS_QUERY = "SELECT * FROM interpretations_final ORDER BY rowid"
+
+
+def connect(db_path: Path, tuned: bool) -> sqlite3.Connection:
+    if not tuned:
+        return sqlite3.connect(str(db_path))
+    conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro&immutable=1", uri=True)
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.execute("PRAGMA cache_size = -65536")
+    return conn
+
+
+def time_query(conn: sqlite3.Connection, query: str, params_list) -> float:
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    for params in params_list:
+        cursor.execute(query, params)
+        cursor.fetchall()
+    return (time.perf_counter() - start) / max(len(params_list), 1) * 1e6
+
+
+def run(db_path: Path) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, tuned in [("before", False), ("after", True)]:
+            copy_path = Path(tmp_dir) / f"{name}.sqlite"
+            shutil.copy(db_path, copy_path)
+            if tuned:
+                build_indexes(str(copy_path))
+            conn = connect(copy_path, tuned)
+            results[name] = {
+                "rules_query": time_query(conn, RULES_QUERY, [()]),
+                "interpretations_query": time_query(conn, INTERPRETATIONS_QUERY, [()]),
+            }
+            conn.close()
+    return results
+
+
+def main():
+    results = run(Path(sys.argv[1]))
+    print("query\tbefore_us\tafter_us")
+    for query in results["before"]:
+        print(f"{query}\t{results['before'][query]:.1f}\t{results['after'][query]:.1f}")
+
+
+if __name__ == "__main__":
+    main()
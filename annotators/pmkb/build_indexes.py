@@ -0,0 +1,32 @@
+"""
+Builds the indexes of the PMKB database which ships with this module.
+
+    python build_indexes.py data/pmkb.sqlite
+
+interpretations_final is indexed on gene_name, for lookups of the
+interpretations of a gene. The annotator reads both tables whole at setup,
+in rowid order, which no index speeds up, so variant is not indexed. The
+statistics for the query planner are refreshed with ANALYZE, and the file is
+compacted with VACUUM, so that the scans read contiguous pages.
+"""
+import sys
+import sqlite3
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS interpretations_final_gene_name ON interpretations_final (gene_name)",
+]
+
+
+def build_indexes(db_path: str):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    for index in INDEXES:
+        cursor.execute(index)
+    cursor.execute("ANALYZE")
+    conn.commit()
+    cursor.execute("VACUUM")
+    conn.close()
+
+
+if __name__ == "__main__":
+    build_indexes(sys.argv[1])
@@ -1,354 +1,549 @@
 from typing import Optional
+from typing import Dict
 from typing import List
+from typing import Tuple
 from oakvar import BaseAnnotator
+from bisect import bisect_right
+from functools import lru_cache
 import re
 
+PROTEIN_LETTERS_3TO1 = {
+    "Ala": "A",
+    "Cys": "C",
+    "Asp": "D",
+    "Glu": "E",
+    "Phe": "F",
+    "Gly": "G",
+    "His": "H",
+    "Ile": "I",
+    "Lys": "K",
+    "Leu": "L",
+    "Met": "M",
+    "Asn": "N",
+    "Pro": "P",
+    "Gln": "Q",
+    "Arg": "R",
+    "Ser": "S",
+    "Thr": "T",
+    "Val": "V",
+    "Trp": "W",
+    "Tyr": "Y",
+}
+ONE_LETTER_CODES = {k.upper(): v for k, v in PROTEIN_LETTERS_3TO1.items()}
+ONE_LETTER_CODES["TER"] = "*"
+# Consequence of each sequence ontology, and the pattern of its protein change
+CONSEQUENCES = {
+    "MIS": "missense",
+    "missense_variant": "missense",
+    "FSD": "frameshift",
+    "FSI": "frameshift",
+    "frameshift_insertion": "frameshift",
+    "frameshift_deletion": "frameshift",
+    "INI": "inframe_insertion",
+    "inframe_insertion": "inframe_insertion",
+    "IND": "inframe_deletion",
+    "inframe_deletion": "inframe_deletion",
+    "CSS": "complex_substitution",
+    "complex_substitution": "complex_substitution",
+}
+# The PMKB database is read-only data, so it is opened immutable, without
+# locking, and read through a memory map.
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KB = 64 * 1024
+# Protein changes parsed across variants and samples, bounded for inputs
+# with many distinct changes
+PARSE_CACHE_SIZE = 65536
+# Variants annotated together by process_file
+BATCH_SIZE = 10000
+ACHANGE_PATTERNS = {
+    "missense": re.compile(r"(\w{3})(\d+)(\w{3}|\?)"),
+    "frameshift": re.compile(r"(\w{3})(\d+)"),
+    "inframe_insertion": re.compile(r"(\w{3})(\d+)_?(\w{3})(\d+)ins(\w+)"),
+    "inframe_deletion": re.compile(r"(\w{3})(\d+)_?(\w{3})?(\d+)?del"),
+    "complex_substitution": re.compile(r"(\w{3})(\d+)_?(\w{3})?(\d+)?delins(\w+)"),
+}
+
+
+class PmkbRule:
+    """
+    A PMKB variant rule, parsed once from its achange, which is
+    kind:positions:so:ref:alt or kind:start:end:so:ref:alt.
+    kind is _codon or _exon, and positions are codons or exons as
+    a single number, a range (100-500), a list (12,13,61) or _any.
+    """
+
+    def __init__(self, achange: str, order: int = 0):
+        toks = achange.split(":")
+        self.achange = achange
+        self.order = order
+        self.kind = toks[0]
+        self.so = toks[-3]
+        self.ref = toks[-2]
+        self.alt = toks[-1]
+        self.is_exon = self.kind == "_exon"
+        self.any_so = self.so in ["_any", "any"]
+        self.any_alleles = self.ref == "_any" and self.alt == "_any"
+        self.any_position = toks[1] == "_any"
+        self.positions: Optional[frozenset] = None
+        self.range: Optional[Tuple[int, int]] = None
+        if "-" in toks[1]:
+            start, end = map(int, toks[1].split("-"))
+            self.range = (start, end)
+        elif "," in toks[1]:
+            self.positions = frozenset(int(v) for v in toks[1].split(","))
+        elif not self.any_position:
+            self.positions = frozenset([int(toks[1])])
+        self.start: Optional[int] = int(toks[1]) if toks[1].isdigit() else None
+        self.end: Optional[int] = None
+        if len(toks) == 6 and toks[2].isdigit():
+            self.end = int(toks[2])
+
+    def has_position(self, pos: Optional[int]) -> bool:
+        if pos is None:
+            return False
+        if self.range is not None:
+            return self.range[0] <= pos <= self.range[1]
+        if self.positions is not None:
+            return pos in self.positions
+        return False
+
+    def matches_exon(self, exonno: Optional[int]) -> bool:
+        return self.is_exon and self.has_position(exonno)
+
+    def matches_any(self) -> bool:
+        return self.any_so and self.any_position
+
+
+class PositionIndex:
+    """
+    PMKB rules by codon or exon number. Single positions and lists are
+    kept in a dict, and ranges are sorted by start. A running maximum of
+    range ends lets a query stop scanning to the left as soon as no
+    earlier range can reach the queried position.
+    """
+
+    def __init__(self):
+        self.points: Dict[int, List[PmkbRule]] = {}
+        self.ranges: List[Tuple[int, int, PmkbRule]] = []
+        self.starts: List[int] = []
+        self.max_ends: List[int] = []
+
+    def add(self, rule: PmkbRule):
+        if rule.range is not None:
+            self.ranges.append((rule.range[0], rule.range[1], rule))
+        elif rule.positions is not None:
+            for pos in rule.positions:
+                self.points.setdefault(pos, []).append(rule)
+
+    def build(self):
+        self.ranges.sort(key=lambda v: (v[0], v[1]))
+        self.starts = [v[0] for v in self.ranges]
+        self.max_ends = []
+        max_end = 0
+        for _, end, _ in self.ranges:
+            max_end = max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def query(self, pos: Optional[int]) -> List[PmkbRule]:
+        if pos is None:
+            return []
+        hits = list(self.points.get(pos, []))
+        i = bisect_right(self.starts, pos) - 1
+        while i >= 0 and self.max_ends[i] >= pos:
+            if self.ranges[i][1] >= pos:
+                hits.append(self.ranges[i][2])
+            i -= 1
+        return hits
+
+
+class GeneRules:
+    """
+    The PMKB rules of a gene, with codon rules and exon rules in
+    separate position indexes and the rules for any variant of the gene
+    in their own bucket, which is always a candidate.
+    """
+
+    def __init__(self):
+        self.any_rules: List[PmkbRule] = []
+        self.codons = PositionIndex()
+        self.exons = PositionIndex()
+
+    def add(self, rule: PmkbRule):
+        if rule.matches_any():
+            self.any_rules.append(rule)
+        elif rule.is_exon:
+            self.exons.add(rule)
+        else:
+            self.codons.add(rule)
+
+    def build(self):
+        self.codons.build()
+        self.exons.build()
+
+    def candidates(self, pos: Optional[int], exonno: Optional[int]) -> List[PmkbRule]:
+        """
+        Returns the rules which can match a variant at codon pos in exon
+        exonno, in table order.
+        """
+        rules = self.any_rules + self.codons.query(pos) + self.exons.query(exonno)
+        rules.sort(key=lambda v: v.order)
+        return rules
+
+
+class ParsedAchange:
+    """
+    A protein change of a variant, with positions as codon numbers and
+    alleles in one-letter codes. ref and alt are the reference and
+    alternate amino acids of a missense change, the reference amino
+    acid of a frameshift, the inserted amino acids of an insertion or
+    a complex substitution, and the first and last deleted amino acids
+    of a deletion.
+    """
+
+    def __init__(self, consequence: str, pos: int, end: Optional[int] = None, ref: str = "", alt: str = ""):
+        self.consequence = consequence
+        self.pos = pos
+        self.end = end
+        self.ref = ref
+        self.alt = alt
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_achange(achange: str, so: str) -> Optional[ParsedAchange]:
+    """
+    Parses the protein change of a variant of sequence ontology so.
+    Returns None if PMKB rules do not apply to the sequence ontology.
+    The same protein change is parsed once across variants and samples.
+    """
+    consequence = CONSEQUENCES.get(so)
+    if consequence is None:
+        return None
+    match = ACHANGE_PATTERNS[consequence].search(achange)
+    if match is None:
+        raise Exception(f"{achange} cannot be parsed.")
+    groups = match.groups()
+    pos = int(groups[1])
+    if consequence == "missense":
+        return ParsedAchange(consequence, pos, ref=seq1(groups[0]), alt=seq1(groups[2]))
+    if consequence == "frameshift":
+        return ParsedAchange(consequence, pos, ref=seq1(groups[0]))
+    if consequence == "inframe_deletion":
+        return ParsedAchange(
+            consequence,
+            pos,
+            end=None if groups[3] is None else int(groups[3]),
+            ref=seq1(groups[0]),
+            alt="" if groups[2] is None else seq1(groups[2]),
+        )
+    # convert alt_allele to one letter amino acid notation
+    return ParsedAchange(consequence, pos, alt=seq1(groups[-1]))
+
 
 class Annotator(BaseAnnotator):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.query = """ 
-                    SELECT 
-                        interpretations_final.gene_name, 
-                        interpretations_final.tumor_type,
-                        interpretations_final.tissue_type,
-                        interpretations_final.pmkb_url_interpretations,
-                        interpretations_final.interpretations, 
-                        interpretations_final.citations,
-                        variant.achange, 
-                        variant.pmkb_url_variants 
-                    FROM 
-                        interpretations_final
-                    LEFT JOIN
-                        variant
-                        ON variant.gene = interpretations_final.gene_name
-                    WHERE 
-                        achange = :achange_pmkb AND variant.gene = :gene
-                """
-        self.gene_query: str = """
-            SELECT 
-                achange
-            FROM 
+        self.rules_query: str = """
+            SELECT
+                gene, achange, pmkb_url_variants
+            FROM
                 variant
-            WHERE 
-                gene = :gene 
+            ORDER BY
+                rowid
+            """
+        self.interpretations_query: str = """
+            SELECT
+                gene_name,
+                tumor_type,
+                tissue_type,
+                pmkb_url_interpretations,
+                interpretations,
+                citations
+            FROM
+                interpretations_final
+            ORDER BY
+                rowid
             """
+        self.rules: Dict[str, GeneRules] = {}
+        self.results: Dict[Tuple[str, str], dict] = {}
+        self.interpretations: Dict[str, List[tuple]] = {}
+        self.variant_urls: Dict[Tuple[str, str], str] = {}
+        self.matchers = {
+            "missense": self.annotate_mis,
+            "frameshift": self.annotate_frameshift,
+            "inframe_insertion": self.annotate_inframe_insertion,
+            "inframe_deletion": self.annotate_inframe_deletion,
+            "complex_substitution": self.annotate_css,
+        }
 
-    def add_to_qr(self, achange_pmkb: str, gene: str, qr):
-        if not self.cursor:
+    def connect_db(self):
+        """
+        Opens the PMKB database read-only and immutable, in URI mode, with
+        a memory map and a larger page cache. Queries are kept as
+        attributes, so sqlite3 prepares each of them once and reuses it
+        from its statement cache.
+        """
+        from pathlib import Path
+        import sqlite3
+
+        db_path = Path(self.data_dir) / (self.module_name + ".sqlite")
+        if not db_path.exists():
             return
-        self.cursor.execute(
-            f"{self.query}", {"achange_pmkb": achange_pmkb, "gene": gene}
+        self.dbconn = sqlite3.connect(
+            f"{db_path.resolve().as_uri()}?mode=ro&immutable=1", uri=True
         )
-        qr.append(self.cursor.fetchone())
+        self.cursor = self.dbconn.cursor()
+        self.cursor.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        self.cursor.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
 
-    def annotate_mis(self, achange: str, gene: str, exonno: int, qr, pmkb_variants):
+    def setup(self):
+        """
+        Loads all PMKB rules, parsed and indexed by position, into
+        self.rules by gene, and the output of each (gene, achange) into
+        self.results, so that annotate does not query the database. The
+        output of a rule is the first interpretation of its gene with the
+        achange and the variant URL of the rule. All interpretations of each
+        gene are kept in self.interpretations, in table order.
+        """
         if not self.cursor:
             return
-        # search for the description of missense variant
-        input_ref_alt_pos = re.search(r"(\w{3})(\d+)(\w{3}|\?)", achange)
-        if not input_ref_alt_pos:
-            raise Exception(f"{achange} cannot be parsed.")
-        ref_alt_pos_catch = input_ref_alt_pos.groups()
-        input_pos = int(ref_alt_pos_catch[1])
-        input_ref_allele = seq1(ref_alt_pos_catch[0])
-        input_alt_allele = seq1(ref_alt_pos_catch[2])
-        # loop through results to get a match
-        for row in pmkb_variants:
-            achange_pmkb = row[0]
-            pmkb_achange = achange_pmkb.split(":")
-            # get pos:ref_allele_alt_allele
-            pmkb_pos = codon_trans(pmkb_achange[1])
-            pmkb_ref_allele = pmkb_achange[-2]
-            pmkb_alt_allele = pmkb_achange[-1]
-            pmkb_so = pmkb_achange[-3]
-            pmkb_kind = pmkb_achange[0]
-            # handle _any kind
-            if pmkb_so in ["_any", "any"] and pmkb_pos[0] == -1:
-                self.add_to_qr(achange_pmkb, gene, qr)
-            # match results of pmkb achange with input data
-            elif input_pos in pmkb_pos and (
-                (
-                    pmkb_ref_allele == input_ref_allele
-                    and pmkb_alt_allele == input_alt_allele
-                )
-                or (
-                    pmkb_ref_allele == "_any"
-                    and pmkb_alt_allele == "_any"
-                    and pmkb_kind != "_exon"
+        self.cursor.execute(self.interpretations_query)
+        for row in self.cursor.fetchall():
+            self.interpretations.setdefault(row[0], []).append(row)
+        self.cursor.execute(self.rules_query)
+        for gene, achange, pmkb_url_variants in self.cursor.fetchall():
+            if not achange or (gene, achange) in self.results:
+                continue
+            try:
+                rule = PmkbRule(achange, order=len(self.results))
+            except ValueError:
+                if self.logger:
+                    self.logger.warning(f"{gene} {achange} cannot be parsed.")
+                continue
+            self.rules.setdefault(gene, GeneRules()).add(rule)
+            self.variant_urls[(gene, achange)] = pmkb_url_variants
+            if gene not in self.interpretations:
+                self.results[(gene, achange)] = None
+                continue
+            interpretation = self.interpretations[gene][0]
+            self.results[(gene, achange)] = {
+                "gene_name": interpretation[0],
+                "tumor_type": interpretation[1],
+                "tissue_type": interpretation[2],
+                "pmkb_url_interpretation": interpretation[3],
+                "interpretations": interpretation[4],
+                "citations": interpretation[5],
+                "achange": achange,
+                "pmkb_url_variants": pmkb_url_variants,
+            }
+        for gene_rules in self.rules.values():
+            gene_rules.build()
+
+    def annotate_mis(self, parsed: ParsedAchange, exonno: Optional[int], rules: GeneRules) -> List[PmkbRule]:
+        return [
+            rule for rule in rules.candidates(parsed.pos, exonno)
+            if rule.matches_any()
+            or rule.matches_exon(exonno)
+            or (
+                not rule.is_exon
+                and rule.has_position(parsed.pos)
+                and (
+                    (rule.ref == parsed.ref and rule.alt == parsed.alt)
+                    or rule.any_alleles
                 )
-                or (pmkb_kind == "_exon" and exonno in pmkb_pos)
-            ):
-                self.add_to_qr(achange_pmkb, gene, qr)
+            )
+        ]
 
-    def annotate_frameshift(
-        self, achange: str, gene: str, exonno: int, qr, pmkb_variants
-    ):
-        if not self.cursor:
-            return
-        # get input data for querying the pmkb database
-        input_ref_alt_pos = re.search(r"(\w{3})(\d+)", achange)
-        if input_ref_alt_pos is None:
-            raise Exception(f"{achange} cannot be parsed.")
-        ref_alt_pos_catch = input_ref_alt_pos.groups()
-        input_pos = ref_alt_pos_catch[1]
-        input_ref_allele = seq1(ref_alt_pos_catch[0])
-        # get pmkb pos:ref_allele:alt_allele
-        for row in pmkb_variants:
-            # get pos:ref_allele_alt_allele
-            achange_pmkb = row[0]
-            pmkb_achange = achange_pmkb.split(":")
-            pmkb_pos = codon_trans(pmkb_achange[1])
-            pmkb_ref_allele = pmkb_achange[-2]
-            pmkb_alt_allele = pmkb_achange[-1]
-            pmkb_so = pmkb_achange[-3]
-            pmkb_kind = pmkb_achange[0]
-            # handle _any kind
-            if (pmkb_so == "_any" or pmkb_so == "any") and pmkb_pos[0] == -1:
-                self.add_to_qr(achange_pmkb, gene, qr)
-            elif input_pos in pmkb_pos and (
-                pmkb_ref_allele == input_ref_allele
-                or (pmkb_ref_allele == "_any" and pmkb_alt_allele == "_any")
-                or (pmkb_kind == "_exon" and exonno in pmkb_pos)
-            ):
-                self.add_to_qr(achange_pmkb, gene, qr)
-
-    def annotate_inframe_insertion(
-        self, achange: str, gene: str, exonno: int, qr, pmkb_variants
-    ):
-        if not self.cursor:
-            return
-        input_ref_alt_pos = re.search(r"(\w{3})(\d+)_?(\w{3})(\d+)ins(\w+)", achange)
-        if input_ref_alt_pos is None:
-            raise Exception(f"{achange} cannot be parsed.")
-        ref_alt_pos_catch = input_ref_alt_pos.groups()
-        input_start_pos = ref_alt_pos_catch[1]
-        input_alt_allele = ref_alt_pos_catch[-1]
-        # Query pmkb database
-        # loop through results to get a match
-        for row in pmkb_variants:
-            achange_pmkb = row[0]
-            pmkb_achange = achange_pmkb.split(":")
-            pmkb_pos = codon_trans(pmkb_achange[1])
-            pmkb_ref_allele = pmkb_achange[-2]
-            pmkb_alt_allele = pmkb_achange[-1]
-            input_alt_allele_seq1 = ""
-            pmkb_so = pmkb_achange[-3]
-            pmkb_kind = pmkb_achange[0]
-            # convert alt_allele to one letter amino acid notation
-            if input_alt_allele != None:
-                for i in range(0, len(input_alt_allele) + 1, 3):
-                    if i < len(input_alt_allele):
-                        input_alt_allele_seq1 += seq1(input_alt_allele[i : i + 3])
-            # handle _any kind
-            if (pmkb_so == "_any" or pmkb_so == "any") and pmkb_pos[0] == -1:
-                self.add_to_qr(achange_pmkb, gene, qr)
-            elif input_start_pos in pmkb_pos and (
-                pmkb_alt_allele == input_alt_allele_seq1
-                or (pmkb_ref_allele == "_any" and pmkb_alt_allele == "_any")
-                or (pmkb_kind == "_exon" and exonno in pmkb_pos)
-            ):
-                self.add_to_qr(achange_pmkb, gene, qr)
-
-    def annotate_inframe_deletion(
-        self, achange: str, gene: str, exonno: int, qr, pmkb_variants
-    ):
-        input_ref_alt_pos = re.search(r"(\w{3})(\d+)_?(\w{3})?(\d+)?del", achange)
-        if input_ref_alt_pos is None:
-            raise Exception(f"{achange} cannot be parsed.")
-        ref_alt_pos_catch = input_ref_alt_pos.groups()
-        input_ref_allele = seq1(ref_alt_pos_catch[0])
-        input_alt_allele = (
-            "" if ref_alt_pos_catch[2] == None else seq1(ref_alt_pos_catch[2])
-        )
-        input_start_pos = ref_alt_pos_catch[1]
-        input_end_pos = ref_alt_pos_catch[3]
-        input_ref_alt = input_ref_allele + "X" + input_alt_allele
-        for row in pmkb_variants:
-            achange_pmkb = row[0]
-            pmkb_achange = achange_pmkb.split(":")
-            pmkb_start_pos = pmkb_achange[1]
-            pmkb_ref_allele = pmkb_achange[-2]
-            pmkb_alt_allele = pmkb_achange[-1]
-            pmkb_end_pos = pmkb_achange[2] if type(pmkb_achange[2]) is int else ""
-            pmkb_so = pmkb_achange[-3]
-            pmkb_kind = pmkb_achange[0]
-            # convert input ref_allele to one letter notation
-            # handle _any so
-            if (pmkb_so == "_any" or pmkb_so == "any") and pmkb_start_pos == "_any":
-                self.add_to_qr(achange_pmkb, gene, qr)
-            # if the deletion is in an interval
-            elif (
-                (
+    def annotate_frameshift(self, parsed: ParsedAchange, exonno: Optional[int], rules: GeneRules) -> List[PmkbRule]:
+        return [
+            rule for rule in rules.candidates(parsed.pos, exonno)
+            if rule.matches_any()
+            or rule.matches_exon(exonno)
+            or (
+                not rule.is_exon
+                and rule.has_position(parsed.pos)
+                and (rule.ref == parsed.ref or rule.any_alleles)
+            )
+        ]
+
+    def annotate_inframe_insertion(self, parsed: ParsedAchange, exonno: Optional[int], rules: GeneRules) -> List[PmkbRule]:
+        return [
+            rule for rule in rules.candidates(parsed.pos, exonno)
+            if rule.matches_any()
+            or rule.matches_exon(exonno)
+            or (
+                not rule.is_exon
+                and rule.has_position(parsed.pos)
+                and (rule.alt == parsed.alt or rule.any_alleles)
+            )
+        ]
+
+    def annotate_inframe_deletion(self, parsed: ParsedAchange, exonno: Optional[int], rules: GeneRules) -> List[PmkbRule]:
+        return [
+            rule for rule in rules.candidates(parsed.pos, exonno)
+            if rule.matches_any()
+            or rule.matches_exon(exonno)
+            or (
+                not rule.is_exon
+                and rule.start == parsed.pos
+                and (
+                    # if the deletion is in an interval
                     (
-                        input_end_pos != ""
-                        and pmkb_end_pos != ""
-                        and input_alt_allele != ""
-                    )
-                    and (
-                        pmkb_start_pos == input_start_pos
-                        and pmkb_ref_allele == input_ref_alt
-                        and pmkb_end_pos == input_end_pos
+                        parsed.end is not None
+                        and parsed.alt != ""
+                        and rule.end == parsed.end
+                        and rule.ref == parsed.ref + "X" + parsed.alt
                     )
+                    or rule.ref == parsed.ref
+                    or rule.any_alleles
                 )
-                or (
-                    pmkb_ref_allele == input_ref_allele
-                    and pmkb_start_pos == input_start_pos
-                )
-                or (
-                    pmkb_ref_allele == "_any"
-                    and pmkb_alt_allele == "_any"
-                    and pmkb_start_pos == input_start_pos
-                )
-                or (pmkb_kind == "_exon" and exonno in pmkb_start_pos)
-            ):
-                self.add_to_qr(achange_pmkb, gene, qr)
+            )
+        ]
 
-    def annotate_css(self, achange: str, gene: str, exonno: int, qr, pmkb_variants):
-        if not self.cursor:
-            return
-        input_ref_alt_pos = re.search(
-            r"(\w{3})(\d+)_?(\w{3})?(\d+)?delins(\w+)", achange
-        )
-        if input_ref_alt_pos is None:
-            raise Exception(f"{achange} cannot be parsed.")
-        ref_alt_pos_catch = input_ref_alt_pos.groups()
-        input_start_pos = ref_alt_pos_catch[1]
-        input_end_pos = ref_alt_pos_catch[3] if ref_alt_pos_catch[3] != None else ""
-        input_alt_allele = ref_alt_pos_catch[-1]
-        for row in pmkb_variants:
-            achange_pmkb = row[0]
-            pmkb_achange = achange_pmkb.split(":")
-            # get pos:ref_allele_alt_allele
-            pmkb_start_pos = pmkb_achange[1]
-            # get pos:alt_allele
-            pmkb_end_pos = pmkb_achange[2]
-            pmkb_ref_allele = pmkb_achange[-2]
-            pmkb_alt_allele = pmkb_achange[-1]
-            input_alt_allele_seq1 = ""
-            pmkb_so = pmkb_achange[-3]
-            pmkb_kind = pmkb_achange[0]
-            # convert alt_allele to one letter amino acid notation
-            if input_alt_allele != None:
-                for i in range(0, len(input_alt_allele) + 1, 3):
-                    if i < len(input_alt_allele):
-                        input_alt_allele_seq1 += seq1(input_alt_allele[i : i + 3])
-            # handle _any so
-            if (pmkb_so == "_any" or pmkb_so == "any"):
-                self.add_to_qr(achange_pmkb, gene, qr)
-            # if variant description has start and end pos - check matching with the pmkb database
-            elif (
-                (
-                    input_end_pos != ""
-                    and pmkb_start_pos == input_start_pos
-                    and (
-                        pmkb_end_pos == input_end_pos
-                        and pmkb_alt_allele == input_alt_allele_seq1
-                    )
-                )
-                or (
-                    pmkb_start_pos == input_start_pos
-                    and pmkb_alt_allele == input_alt_allele_seq1
+    def annotate_css(self, parsed: ParsedAchange, exonno: Optional[int], rules: GeneRules) -> List[PmkbRule]:
+        return [
+            rule for rule in rules.candidates(parsed.pos, exonno)
+            if rule.matches_any()
+            or rule.matches_exon(exonno)
+            or (
+                not rule.is_exon
+                and (
+                    (rule.start == parsed.pos and rule.alt == parsed.alt)
+                    or (rule.has_position(parsed.pos) and rule.any_alleles)
                 )
-                or (pmkb_ref_allele == "_any" and pmkb_alt_allele == "_any")
-                or (pmkb_kind == "_exon" and exonno == pmkb_start_pos)
-            ):
-                self.add_to_qr(achange_pmkb, gene, qr)
+            )
+        ]
+
+    def process_file(self):
+        """
+        Reads the input in chunks of BATCH_SIZE variants, annotates each
+        chunk with annotate_batch and writes the outputs in input order, as
+        BaseAnnotator.process_file does one variant at a time. If a chunk
+        fails, its variants are annotated one at a time, so that the error
+        is logged for the variant which caused it.
+        """
+        chunk = []
+        for lnum, line, input_data, _ in self._get_input():
+            try:
+                self.log_progress(lnum)
+                # * allele and undefined non-canonical chroms are skipped.
+                if self.is_star_allele(input_data) or self.should_skip_chrom(input_data):
+                    continue
+            except Exception as e:
+                self.log_input_exception(lnum, line, input_data, e)
+                continue
+            chunk.append((lnum, line, input_data))
+            if len(chunk) >= BATCH_SIZE:
+                self.write_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.write_chunk(chunk)
+
+    def write_chunk(self, chunk: List[tuple]):
+        try:
+            outputs = self.annotate_batch([input_data for _, _, input_data in chunk])
+        except Exception:
+            outputs = None
+        for i, (lnum, line, input_data) in enumerate(chunk):
+            try:
+                output_dict = self.annotate(input_data) if outputs is None else outputs[i]
+                if output_dict is None:
+                    continue
+                output_dict = self.handle_jsondata(output_dict)
+                if output_dict:
+                    output_dict[self._id_col_name] = input_data[self._id_col_name]
+                output_dict = self.fill_empty_output(output_dict)
+                if self.output_writer:
+                    self.output_writer.write_data(output_dict)
+            except Exception as e:
+                self.log_input_exception(lnum, line, input_data, e)
+
+    def log_input_exception(self, lnum, line, input_data: dict, e: Exception):
+        fn = self.primary_input_reader.path if self.primary_input_reader else "?"
+        self._log_runtime_exception(lnum, line, input_data, e, fn=fn)
 
     def annotate(self, input_data: dict, secondary_data: Optional[dict] = None):
         assert input_data is not None
-        if not self.cursor:
-            return None
         # get data for querying the pmkb database from input_data
         gene: str = input_data.get("hugo", "")
         if not gene:
             return None
-        self.cursor.execute(self.gene_query, {"gene": gene})
-        pmkb_variants = self.cursor.fetchall()
+        _ = secondary_data
+        return self.annotate_gene_variant(gene, self.rules.get(gene), input_data)
+
+    def annotate_gene_variant(self, gene: str, rules: Optional[GeneRules], input_data: dict) -> Optional[dict]:
         exonno = input_data.get("exonno", -1)
         if exonno is not None:
             exonno = int(exonno)
         achange: str = input_data.get("achange", "")
         if not achange:
             raise Exception(f"achange is absent in input_data.")
-        qr = []
-        # exonno = input_data['exonno']
-        variant_type = input_data["so"]
-        # Handle missense variants
-        if variant_type in ["MIS", "missense_variant"]:
-            self.annotate_mis(achange, gene, exonno, qr, pmkb_variants)
-        # handle frameshift mutations
-        elif (
-            variant_type == "FSD"
-            or variant_type == "FSI"
-            or variant_type == "frameshift_insertion"
-            or variant_type == "frameshift_deletion"
-        ):
-            self.annotate_frameshift(achange, gene, exonno, qr, pmkb_variants)
-        # handle insertion mutation cases
-        elif variant_type in ["INI", "inframe_insertion"]:
-            self.annotate_inframe_insertion(achange, gene, exonno, qr, pmkb_variants)
-        # Handle deletion category
-        elif variant_type in ["IND", "inframe_deletion"]:
-            self.annotate_inframe_deletion(achange, gene, exonno, qr, pmkb_variants)
-        elif variant_type in ["CSS", "complex_substitution"]:
-            self.annotate_css(achange, gene, exonno, qr, pmkb_variants)
-            # Handle deletion cases
-        if qr and None not in qr:
-            return {
-                "gene_name": qr[0][0],
-                "tumor_type": qr[0][1],
-                "tissue_type": qr[0][2],
-                "pmkb_url_interpretation": qr[0][3],
-                "interpretations": qr[0][4],
-                "citations": qr[0][5],
-                "achange": qr[0][6],
-                "pmkb_url_variants": qr[0][7],
-            }
-        _ = secondary_data
+        if not rules:
+            return None
+        parsed = parse_achange(achange, input_data["so"])
+        if parsed is None:
+            return None
+        matches = self.matchers[parsed.consequence](parsed, exonno, rules)
+        if matches:
+            result = self.results[(gene, matches[0].achange)]
+            if result is not None:
+                result = dict(result)
+                result["all_interpretations"] = self.get_all_interpretations(gene, matches)
+                return result
+        return None
 
+    def get_all_interpretations(self, gene: str, matches: List[PmkbRule]) -> List[list]:
+        """
+        Returns a row for each interpretation of the gene, from the
+        preloaded tables, with the achanges and variant URLs of all
+        matching rules joined into its first two columns.
+        """
+        achanges = "; ".join(rule.achange for rule in matches)
+        pmkb_url_variants = "; ".join(self.variant_urls[(gene, rule.achange)] or "" for rule in matches)
+        return [
+            [
+                achanges,
+                pmkb_url_variants,
+                interpretation[1],
+                interpretation[2],
+                interpretation[3],
+                interpretation[4],
+                interpretation[5],
+            ]
+            for interpretation in self.interpretations[gene]
+        ]
 
-def codon_trans(seq) -> List[int]:
-    if "-" in seq:
-        seq = [codon for codon in list(map(int, seq.split("-")))]
-        seq = [i for i in range(seq[0], seq[1] + 1)]
-        return seq
-    if "," in seq:
-        seq = [int(codon) for codon in seq.split(",")]
-        return seq
-    else:
-        if seq != "_any":
-            return [int(seq)]
-        else:
-            return [-1]
+    def annotate_batch(self, input_datas: List[dict]) -> List[Optional[dict]]:
+        """
+        Annotates a list of input_data dicts and returns their outputs in
+        the same order. Variants are grouped by hugo, so each gene's rules
+        are looked up once, and a variant with the same protein change,
+        sequence ontology and exon as an earlier one in its gene reuses
+        its matches. An error in any variant is raised.
+        """
+        outputs: List[Optional[dict]] = [None] * len(input_datas)
+        indexes_by_gene: Dict[str, List[int]] = {}
+        for i, input_data in enumerate(input_datas):
+            gene = input_data.get("hugo")
+            if gene:
+                indexes_by_gene.setdefault(gene, []).append(i)
+        for gene, indexes in indexes_by_gene.items():
+            rules = self.rules.get(gene)
+            if not rules:
+                continue
+            outputs_by_change: Dict[Tuple, Optional[dict]] = {}
+            for i in indexes:
+                input_data = input_datas[i]
+                key = (input_data.get("achange"), input_data.get("so"), input_data.get("exonno"))
+                if key not in outputs_by_change:
+                    outputs_by_change[key] = self.annotate_gene_variant(gene, rules, input_data)
+                output = outputs_by_change[key]
+                outputs[i] = None if output is None else dict(output)
+        return outputs
 
 
 def seq1(seq, custom_map=None):
-    protein_letters_3to1 = {
-        "Ala": "A",
-        "Cys": "C",
-        "Asp": "D",
-        "Glu": "E",
-        "Phe": "F",
-        "Gly": "G",
-        "His": "H",
-        "Ile": "I",
-        "Lys": "K",
-        "Leu": "L",
-        "Met": "M",
-        "Asn": "N",
-        "Pro": "P",
-        "Gln": "Q",
-        "Arg": "R",
-        "Ser": "S",
-        "Thr": "T",
-        "Val": "V",
-        "Trp": "W",
-        "Tyr": "Y",
-    }
-    if custom_map is None:
-        custom_map = {"Ter": "*"}
-    onecode = {k.upper(): v for k, v in protein_letters_3to1.items()}
-    onecode.update((k.upper(), v) for k, v in custom_map.items())
-    seqlist: List[str] = [seq[3 * i : 3 * (i + 1)] for i in range(len(seq) // 3)]
-    return "".join(onecode.get(aa.upper(), "?") for aa in seqlist)
+    onecode = ONE_LETTER_CODES
+    if custom_map is not None:
+        onecode = {k.upper(): v for k, v in PROTEIN_LETTERS_3TO1.items()}
+        onecode.update((k.upper(), v) for k, v in custom_map.items())
+    return "".join(onecode.get(seq[i : i + 3].upper(), "?") for i in range(0, len(seq) - 2, 3))
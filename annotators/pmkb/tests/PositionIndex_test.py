@@ -0,0 +1,78 @@
+import random
+from pmkb import PmkbRule
+from pmkb import PositionIndex
+
+
+def expand(rules):
+    # The index of every position of every rule, which queries must equal
+    points = {}
+    for rule in rules:
+        if rule.range is not None:
+            positions = range(rule.range[0], rule.range[1] + 1)
+        else:
+            positions = rule.positions or []
+        for pos in positions:
+            points.setdefault(pos, []).append(rule)
+    return points
+
+
+def make_index(rules):
+    index = PositionIndex()
+    for rule in rules:
+        index.add(rule)
+    index.build()
+    return index
+
+
+def orders(rules):
+    return sorted(rule.order for rule in rules)
+
+
+class TestPositionIndex:
+
+    def test_point_list_and_range(self):
+        rules = [
+            PmkbRule("_codon:600:MIS:V:E", 0),
+            PmkbRule("_codon:12,13,61:MIS:_any:_any", 1),
+            PmkbRule("_codon:100-500:_any:_any:_any", 2),
+        ]
+        index = make_index(rules)
+        assert orders(index.query(600)) == [0]
+        assert orders(index.query(13)) == [1]
+        assert orders(index.query(100)) == [2]
+        assert orders(index.query(500)) == [2]
+        assert index.query(501) == []
+        assert index.query(None) == []
+
+    def test_nested_ranges(self):
+        # A long range which starts first must still be found past the end
+        # of shorter ranges which start after it.
+        rules = [
+            PmkbRule("_exon:1-30:_any:_any:_any", 0),
+            PmkbRule("_exon:2-3:_any:_any:_any", 1),
+            PmkbRule("_exon:5-6:_any:_any:_any", 2),
+        ]
+        index = make_index(rules)
+        assert orders(index.query(4)) == [0]
+        assert orders(index.query(5)) == [0, 2]
+        assert orders(index.query(31)) == []
+
+    def test_matches_expansion(self):
+        rng = random.Random(0)
+        rules = []
+        for order in range(300):
+            kind = rng.randrange(3)
+            if kind == 0:
+                start = rng.randint(1, 2000)
+                end = start + rng.choice([0, rng.randint(1, 50), rng.randint(1, 1500)])
+                achange = f"_codon:{start}-{end}:_any:_any:_any"
+            elif kind == 1:
+                positions = ",".join(str(rng.randint(1, 2000)) for _ in range(rng.randint(2, 4)))
+                achange = f"_codon:{positions}:MIS:_any:_any"
+            else:
+                achange = f"_codon:{rng.randint(1, 2000)}:MIS:A:V"
+            rules.append(PmkbRule(achange, order))
+        index = make_index(rules)
+        points = expand(rules)
+        for pos in range(0, 3600):
+            assert orders(index.query(pos)) == orders(points.get(pos, []))
@@ -0,0 +1,26 @@
+class TestAllInterpretations:
+
+    def test_one_row_per_interpretation(self, annotator):
+        input_data = {"hugo": "BRAF", "achange": "p.Val600Glu", "so": "missense_variant", "exonno": "15"}
+        output = annotator.annotate(input_data)
+        assert output["achange"] == "_codon:600:MIS:V:E"
+        assert output["all_interpretations"] == [
+            [
+                "_codon:600:MIS:V:E; _exon:15:_any:_any:_any",
+                "url/braf600; url/braf15",
+                "melanoma",
+                "skin",
+                "iurl/braf/1",
+                "interp braf 1",
+                "cit 1",
+            ],
+            [
+                "_codon:600:MIS:V:E; _exon:15:_any:_any:_any",
+                "url/braf600; url/braf15",
+                "glioma",
+                "brain",
+                "iurl/braf/2",
+                "interp braf 2",
+                "cit 2",
+            ],
+        ]
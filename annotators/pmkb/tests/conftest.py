@@ -0,0 +1,47 @@
+import sqlite3
+from pathlib import Path
+import pytest
+import yaml
+import pmkb
+
+VARIANTS = [
+    ("BRAF", "_codon:600:MIS:V:E", "url/braf600"),
+    ("BRAF", "_exon:15:_any:_any:_any", "url/braf15"),
+    ("EGFR", "_codon:746:750:IND:_any:_any", "url/egfr746"),
+]
+INTERPRETATIONS = [
+    ("BRAF", "melanoma", "skin", "iurl/braf/1", "interp braf 1", "cit 1"),
+    ("BRAF", "glioma", "brain", "iurl/braf/2", "interp braf 2", "cit 2"),
+    ("EGFR", "lung cancer", "lung", "iurl/egfr/1", "interp egfr 1", "cit 3"),
+]
+
+
+@pytest.fixture
+def annotator(mocker):
+    # An Annotator on an in-memory PMKB database, without the job that
+    # BaseAnnotator.__init__ sets up
+    mocker.patch.object(pmkb.BaseAnnotator, "__init__", lambda self, *args, **kwargs: None)
+    annotator = pmkb.Annotator()
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE variant (gene TEXT, achange TEXT, pmkb_url_variants TEXT)")
+    conn.execute(
+        "CREATE TABLE interpretations_final (gene_name TEXT, tumor_type TEXT, tissue_type TEXT,"
+        " pmkb_url_interpretations TEXT, interpretations TEXT, citations TEXT)"
+    )
+    conn.executemany("INSERT INTO variant VALUES (?, ?, ?)", VARIANTS)
+    conn.executemany("INSERT INTO interpretations_final VALUES (?, ?, ?, ?, ?, ?)", INTERPRETATIONS)
+    annotator.dbconn = conn
+    annotator.cursor = conn.cursor()
+    annotator.logger = None
+    with open(Path(pmkb.__file__).parent / "pmkb.yml") as f:
+        annotator.conf = yaml.safe_load(f)
+    annotator.output_columns = annotator.conf["output_columns"]
+    annotator.make_json_colnames()
+    annotator.supported_chroms = {"chr7"}
+    annotator.last_status_update_time = None
+    annotator._id_col_name = "uid"
+    annotator.primary_input_reader = None
+    annotator.output_writer = mocker.Mock()
+    annotator._log_runtime_exception = mocker.Mock()
+    annotator.setup()
+    return annotator
@@ -0,0 +1,58 @@
+import json
+import pmkb
+
+
+def make_input(uid, hugo, achange, so, exonno="15", chrom="chr7"):
+    return {"uid": uid, "chrom": chrom, "hugo": hugo, "achange": achange, "so": so, "exonno": exonno}
+
+
+def feed(annotator, input_datas):
+    # Rows as BaseAnnotator._get_input yields them
+    annotator._get_input = lambda: (
+        (lnum, f"line {lnum}", input_data, {}) for lnum, input_data in enumerate(input_datas, start=1)
+    )
+
+
+def written(annotator):
+    return [call.args[0] for call in annotator.output_writer.write_data.call_args_list]
+
+
+class TestProcessFile:
+
+    def test_writes_batch_outputs_in_input_order(self, annotator, mocker):
+        mocker.patch.object(pmkb, "BATCH_SIZE", 2)
+        annotate_batch = mocker.spy(annotator, "annotate_batch")
+        input_datas = [
+            make_input(1, "BRAF", "p.Val600Glu", "missense_variant"),
+            make_input(2, "TP53", "p.Arg175His", "missense_variant"),
+            make_input(3, "EGFR", "p.Glu746_Ala750del", "inframe_deletion", exonno="19"),
+            make_input(4, "BRAF", "p.Val600Glu", "missense_variant", chrom="chrUn"),
+            make_input(5, "BRAF", "p.Gly469Ala", "missense_variant"),
+        ]
+        feed(annotator, input_datas)
+        annotator.process_file()
+        assert annotate_batch.call_count == 2
+        outputs = written(annotator)
+        assert [output["uid"] for output in outputs] == [1, 3, 5]
+        assert [output["achange"] for output in outputs] == [
+            "_codon:600:MIS:V:E",
+            "_codon:746:750:IND:_any:_any",
+            "_exon:15:_any:_any:_any",
+        ]
+        for output in outputs:
+            assert isinstance(output["all_interpretations"], str)
+            json.loads(output["all_interpretations"])
+        annotator._log_runtime_exception.assert_not_called()
+
+    def test_failed_chunk_logs_the_failed_variant(self, annotator):
+        input_datas = [
+            make_input(1, "BRAF", "p.Val600Glu", "missense_variant"),
+            make_input(2, "BRAF", "", "missense_variant"),
+            make_input(3, "EGFR", "p.Glu746_Ala750del", "inframe_deletion", exonno="19"),
+        ]
+        feed(annotator, input_datas)
+        annotator.process_file()
+        assert [output["uid"] for output in written(annotator)] == [1, 3]
+        annotator._log_runtime_exception.assert_called_once()
+        lnum, line, input_data, _ = annotator._log_runtime_exception.call_args.args
+        assert (lnum, line, input_data["uid"]) == (2, "line 2", 2)
@@ -1,14 +1,132 @@
+from typing import Any
+from typing import Optional
 from typing import List
 from typing import Dict
+from typing import Tuple
+from typing import Iterator
 from oakvar import BaseConverter
+from bisect import bisect_right
+import copy
 
 
+class FeatureIndex:
+    """
+    Sorted per-chromosome interval index of the regions module option, and
+    of the GFF3 features of a region index file, with load.
+
+    Features are sorted by start. A running maximum of end positions lets
+    a query stop scanning to the left as soon as no earlier feature can
+    reach the queried start.
+    """
+
+    COLUMNS = ('start', 'end', 'type', 'source', 'strand', 'feature_id', 'name', 'attributes')
+
+    def __init__(self):
+        self.features: Dict[str, List[Tuple]] = {}
+        self.starts: Dict[str, List[int]] = {}
+        self.max_ends: Dict[str, List[int]] = {}
+
+    def add(self, chrom: str, feature: Tuple):
+        self.features.setdefault(chrom, []).append(feature)
+
+    def build(self):
+        for chrom, features in self.features.items():
+            features.sort(key=lambda v: (v[0], v[1]))
+            self.starts[chrom] = [v[0] for v in features]
+            max_ends = []
+            max_end = 0
+            for feature in features:
+                max_end = max(max_end, feature[1])
+                max_ends.append(max_end)
+            self.max_ends[chrom] = max_ends
+
+    def query(self, chrom: str, start: int, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the features overlapping start-end (1-based, inclusive).
+        """
+        if end is None:
+            end = start
+        features = self.features.get(chrom)
+        if not features:
+            return []
+        max_ends = self.max_ends[chrom]
+        i = bisect_right(self.starts[chrom], end) - 1
+        hits = []
+        while i >= 0 and max_ends[i] >= start:
+            if features[i][1] >= start:
+                hits.append(features[i])
+            i -= 1
+        hits.reverse()
+        return [dict(zip(self.COLUMNS, v), chrom=chrom) for v in hits]
+
+    def __len__(self):
+        return sum([len(v) for v in self.features.values()])
+
+    @staticmethod
+    def save(rows: Iterator[Tuple], path: str):
+        """
+        Writes (chrom,) + feature rows to an SQLite file at path. The file
+        is written under a temporary name and then renamed, so a reader
+        never sees a partial index.
+        """
+        import os
+        import sqlite3
+        from pathlib import Path
+
+        tmp_path = Path(f"{path}.{os.getpid()}.tmp")
+        if tmp_path.exists():
+            tmp_path.unlink()
+        conn = sqlite3.connect(str(tmp_path))
+        conn.execute(
+            'create table features (chrom text, start int, end int, type text, source text, '
+            + 'strand text, feature_id text, name text, attributes text)'
+        )
+        conn.executemany('insert into features values (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.execute('create index features_idx on features (chrom, start, end)')
+        conn.commit()
+        conn.close()
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: str) -> "FeatureIndex":
+        import sqlite3
+
+        index = cls()
+        conn = sqlite3.connect(path)
+        for row in conn.execute('select * from features order by chrom, start, end'):
+            index.add(row[0], tuple(row[1:]))
+        conn.close()
+        index.build()
+        return index
+
 
 class Converter(BaseConverter):
 
+    ZYGOSITY_CODES = {
+        'heterozygous': 'het',
+        'homozygous': 'hom',
+        'hemizygous': 'hom',
+        'het': 'het',
+        'hom': 'hom',
+    }
+    DEFAULT_SAMPLE = 'unknown'
+    FORMAT_EXTS = ('gff', 'gvf', 'gff3')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.format_name = 'gvf'
+        self.individuals: List[str] = []
+        self.regions: Optional[FeatureIndex] = None
+        self.encoding = "utf-8"
+        self.line_iter: Optional[Iterator[Tuple[int, str]]] = None
+
+    @classmethod
+    def get_format_name(cls, path: str) -> Optional[str]:
+        if path.endswith('.gz'):
+            path = path[:-3]
+        if path.endswith(cls.FORMAT_EXTS):
+            return path.split('.')[-1]
+        return None
 
     def check_format(self, f) -> bool:
         from pathlib import Path
@@ -16,13 +134,288 @@ class Converter(BaseConverter):
         if not Path(f).exists():
             return False
 
-        if f.endswith(('gff', 'gvf', 'gff3')):
+        format_name = self.get_format_name(f)
+        if format_name:
             # reset format_name to the value of the given file
-            self.format_name = f.split('.')[-1]
+            self.format_name = format_name
             return True
         else:
             return False
 
+    def setup(self, input_path: str, encoding: str = "utf-8"):
+        """
+        Reads the ##multi-individual pragma so that Individual indexes
+        in the attributes column can be resolved to sample names.
+        GFF/GFF3 features are written to an SQLite region index instead,
+        with the region_index module option, if the index does not exist
+        or is older than the input. Without the option, a warning is logged,
+        as none of the features is converted.
+        """
+        self.format_name = self.get_format_name(input_path) or self.format_name
+        self.encoding = encoding
+        regions = self.module_options.get("regions")
+        if regions:
+            self.regions = self.parse_regions(regions)
+        if self.format_name in ("gff", "gff3"):
+            index_path = self.module_options.get("region_index")
+            if self.get_standardized_module_option(index_path) is True:
+                index_path = input_path + ".regions.sqlite"
+            if not index_path:
+                from logging import getLogger
+
+                getLogger("oakvar.converter").warning(
+                    f"{input_path}: GFF/GFF3 features are not converted into variants. "
+                    + "Use the region_index module option to write them to a region index."
+                )
+            elif self.is_stale(str(index_path), input_path):
+                FeatureIndex.save(self.iter_features(input_path, encoding=encoding), str(index_path))
+            return
+        with self.open_input(input_path, encoding=encoding) as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                if line.startswith('##multi-individual'):
+                    names = line[len('##multi-individual'):].strip()
+                    self.individuals = [
+                        v for v in names.replace(',', ' ').split() if v
+                    ]
+
+    @staticmethod
+    def open_input(input_path: str, encoding: str = "utf-8"):
+        if input_path.endswith('.gz'):
+            import gzip
+
+            # bgzip output is a series of gzip members, which gzip reads in order.
+            return gzip.open(input_path, 'rt', encoding=encoding)
+        return open(input_path, encoding=encoding)
+
+    @staticmethod
+    def get_chrom(chrom: str) -> str:
+        return chrom if 'chr' in chrom else 'chr' + chrom
+
+    def parse_regions(self, regions) -> FeatureIndex:
+        """
+        Parses the regions module option, which is a comma-separated list of
+        chrom, chrom:start-end (1-based, inclusive) or the path to a BED file.
+        """
+        from pathlib import Path
+
+        index = FeatureIndex()
+        if isinstance(regions, str):
+            regions = regions.split(',')
+        for region in regions:
+            region = str(region).strip()
+            if not region:
+                continue
+            if Path(region).is_file():
+                with open(region) as f:
+                    for line in f:
+                        toks = line.split('\t')
+                        if line.startswith(('#', 'track', 'browser')) or len(toks) < 3:
+                            continue
+                        index.add(self.get_chrom(toks[0]), (int(toks[1]) + 1, int(toks[2])))
+                continue
+            chrom, _, span = region.partition(':')
+            if span:
+                start, _, end = span.replace(',', '').partition('-')
+                start = int(start)
+                end = int(end) if end else start
+            else:
+                start, end = 1, 2 ** 31 - 1
+            index.add(self.get_chrom(chrom), (start, end))
+        index.build()
+        return index
+
+    def get_merged_regions(self) -> List[Tuple[str, int, int]]:
+        merged = []
+        if not self.regions:
+            return merged
+        for chrom, features in self.regions.features.items():
+            for start, end in [v[:2] for v in features]:
+                if merged and merged[-1][0] == chrom and start <= merged[-1][2] + 1:
+                    merged[-1] = (chrom, merged[-1][1], max(merged[-1][2], end))
+                else:
+                    merged.append((chrom, start, end))
+        return merged
+
+    def iter_lines(self, input_path: str, encoding: str = "utf-8") -> Iterator[Tuple[int, str]]:
+        """
+        Yields (line_no, line). With the regions module option, a bgzipped
+        input with a .tbi index is read through tabix, so only the blocks
+        overlapping the regions are decompressed. Line numbers then count
+        the fetched lines. Other inputs are read whole and filtered.
+        """
+        from pathlib import Path
+
+        if self.regions and input_path.endswith('.gz') and Path(input_path + '.tbi').exists():
+            try:
+                import pysam
+            except ImportError:
+                pysam = None
+            if pysam:
+                yield from self.iter_tabix_lines(pysam.TabixFile(input_path, encoding=encoding))
+                return
+        with self.open_input(input_path, encoding=encoding) as f:
+            line_no = 0
+            for line in f:
+                line_no += 1
+                if line.startswith('##FASTA'):
+                    break
+                if self.regions and not line.startswith('#') and line.strip():
+                    toks = line.split('\t') if '\t' in line else line.split()
+                    if len(toks) < 5:
+                        continue
+                    try:
+                        start, end = int(toks[3]), int(toks[4])
+                    except ValueError:
+                        # Passed on so that convert_line reports it as an error line.
+                        yield line_no, line
+                        continue
+                    if not self.regions.query(self.get_chrom(toks[0]), start, end):
+                        continue
+                yield line_no, line
+
+    def iter_tabix_lines(self, tbx) -> Iterator[Tuple[int, str]]:
+        contigs = set(tbx.contigs)
+        line_no = 0
+        prev_chrom, prev_end = None, 0
+        for chrom, start, end in self.get_merged_regions():
+            contig = chrom if chrom in contigs else chrom[3:]
+            if contig not in contigs:
+                continue
+            for line in tbx.fetch(contig, start - 1, end):
+                toks = line.split('\t')
+                # Lines spanning two regions were returned for the previous one.
+                if chrom == prev_chrom and int(toks[3]) <= prev_end:
+                    continue
+                line_no += 1
+                yield line_no, line
+            prev_chrom, prev_end = chrom, end
+        tbx.close()
+
+    def get_variant_lines(
+        self, input_path: str, num_pool: int, start_line_no: int, batch_size: int
+    ) -> Tuple[Dict[int, List[Tuple[int, str]]], bool]:
+        """
+        Hands out the lines of iter_lines in num_pool chunks of batch_size,
+        so that gzipped inputs and the regions option are read the same way
+        as plain ones. The lines of each input are read in one pass.
+        """
+        from itertools import islice
+
+        if start_line_no == 1 or self.line_iter is None:
+            self.line_iter = self.iter_lines(input_path, encoding=self.encoding)
+        lines: Dict[int, List[Tuple[int, str]]] = {}
+        immature_exit = True
+        for chunk_no in range(num_pool):
+            lines[chunk_no] = list(islice(self.line_iter, batch_size)) if immature_exit else []
+            if len(lines[chunk_no]) < batch_size:
+                immature_exit = False
+        return lines, immature_exit
+
+    @staticmethod
+    def is_stale(index_path: str, input_path: str) -> bool:
+        from pathlib import Path
+
+        index = Path(index_path)
+        return not index.exists() or index.stat().st_mtime < Path(input_path).stat().st_mtime
+
+    def iter_features(self, input_path: str, encoding: str = "utf-8") -> Iterator[Tuple]:
+        for _, line in self.iter_lines(input_path, encoding=encoding):
+            if line.startswith('#') or not line.strip():
+                continue
+            line_values = line.rstrip('\r\n').split('\t')
+            if len(line_values) < 9:
+                continue
+            try:
+                start, end = int(line_values[3]), int(line_values[4])
+            except ValueError:
+                continue
+            attrs = self.parse_attributes(line_values[8])
+            yield (
+                self.get_chrom(line_values[0]),
+                start,
+                end,
+                line_values[2],
+                line_values[1],
+                line_values[6],
+                attrs.get('ID'),
+                attrs.get('Name'),
+                line_values[8],
+            )
+
+    @staticmethod
+    def parse_attributes(column: str) -> Dict[str, str]:
+        attrs = {}
+        for val in column.strip().split(';'):
+            key, sep, value = val.partition('=')
+            if sep:
+                attrs[key.strip()] = value.strip()
+        return attrs
+
+    @staticmethod
+    def get_int(value: Optional[str]) -> Optional[int]:
+        if value is None or value in ('', '.'):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return None
+
+    def get_sample_calls(self, attrs: Dict[str, str], variant_seqs: List[str]) -> List[Dict[str, Any]]:
+        """
+        Decodes Genotype, Zygosity, Variant_reads and Total_reads into
+        one call per individual.
+
+        Single individual:
+            Genotype=0:1;Zygosity=heterozygous;Variant_reads=8,11;Total_reads=19
+        Multiple individuals (##multi-individual pragma):
+            Individual=0,1;Genotype=0:1,1:1;Variant_reads=8:11,0:20;Total_reads=19,20
+
+        Genotype and Variant_reads refer to Variant_seq by index.
+        """
+        if 'Individual' in attrs:
+            individual_idxs = attrs['Individual'].split(',')
+            genotypes = attrs['Genotype'].split(',') if 'Genotype' in attrs else []
+            zygosities = attrs['Zygosity'].split(',') if 'Zygosity' in attrs else []
+            variant_reads = [v.split(':') for v in attrs['Variant_reads'].split(',')] if 'Variant_reads' in attrs else []
+            total_reads = attrs['Total_reads'].split(',') if 'Total_reads' in attrs else []
+        else:
+            individual_idxs = [None]
+            genotypes = [attrs['Genotype']] if 'Genotype' in attrs else []
+            zygosities = [attrs['Zygosity']] if 'Zygosity' in attrs else []
+            variant_reads = [attrs['Variant_reads'].split(',')] if 'Variant_reads' in attrs else []
+            total_reads = [attrs['Total_reads']] if 'Total_reads' in attrs else []
+        calls = []
+        for i, individual_idx in enumerate(individual_idxs):
+            sample_id = self.DEFAULT_SAMPLE
+            idx = self.get_int(individual_idx)
+            if idx is not None and idx < len(self.individuals):
+                sample_id = self.individuals[idx]
+            elif individual_idx is not None:
+                sample_id = individual_idx
+            if i < len(genotypes):
+                seq_idxs = [self.get_int(v) for v in genotypes[i].split(':')]
+                alleles = [
+                    variant_seqs[v] for v in seq_idxs
+                    if v is not None and v < len(variant_seqs)
+                ]
+            else:
+                alleles = variant_seqs
+            zygosity = None
+            if i < len(zygosities):
+                zygosity = self.ZYGOSITY_CODES.get(zygosities[i].lower())
+            elif len(alleles) > 1:
+                zygosity = 'hom' if len(set(alleles)) == 1 else 'het'
+            calls.append({
+                'sample_id': sample_id,
+                'alleles': alleles,
+                'zygosity': zygosity,
+                'variant_reads': variant_reads[i] if i < len(variant_reads) else [],
+                'tot_reads': self.get_int(total_reads[i]) if i < len(total_reads) else None,
+            })
+        return calls
+
     def convert_line(self, line) -> List[Dict]:
         """
         Converts a line from the file into a structured dictionary.
@@ -31,58 +424,60 @@ class Converter(BaseConverter):
 
         if line.startswith('#') or not line.strip():
             return self.IGNORE
+        # GFF/GFF3 features are served from the region index, not as variants.
+        if self.format_name in ("gff", "gff3"):
+            return self.IGNORE
 
-        delimiter = "\t" if self.format_name in ("gff", "gff3") else " "
-        line_values = line.split(delimiter)
+        line = line.rstrip('\r\n')
+        if '\t' in line:
+            line_values = line.split("\t")
+        else:
+            line_values = line.split()
         if len(line_values) < 8:  # Basic validation of line structure
             return None
-        
-        chrom_val = line_values[0] if 'chr' in line_values[0] else 'chr' + line_values[0]
+
+        chrom_val = self.get_chrom(line_values[0])
         pos_val = line_values[3]
         end_pos = line_values[4]
-        ref_base, alt_base, sample = '', '', 'unknown'  # Initialize with default values
-
-
-        if self.format_name == 'gvf':
-            value_attrs = line_values[-1].split(';')
-            for val in value_attrs:
-                if 'Reference_seq' in val:
-                    ref_base = val.split('=')[-1]
-                elif 'Variant_seq' in val:
-                    alt_base = val.split('=')[-1]
-
-            if "," in alt_base:
-                alt_bases = []
-                alt_bases = alt_base.split(',')
-                for alt in alt_bases:
-                    var_dict = {
-                        "chrom": chrom_val,
-                        "pos": pos_val,
-                        'end_pos': end_pos,
-                        "ref_base": ref_base,
-                        "alt_base": alt,
-                        "sample_id": sample,
-                    }
-                    var_dicts.append(var_dict)
-            else:
-                var_dict = {
-                    "chrom": chrom_val,
-                    "pos": pos_val,
-                    'end_pos': end_pos,
-                    "ref_base": ref_base,
-                    "alt_base": alt_base,
-                    "sample_id": sample,
-                }
-                var_dicts.append(var_dict)
-            return var_dicts
-        elif self.format_name in ("gff", "gff3"):
-            var_dict = {
+        # Raises for non-numeric positions, so the line is logged as an error.
+        int(pos_val), int(end_pos)
+
+        attrs = self.parse_attributes(line_values[-1])
+        ref_base = attrs.get('Reference_seq', '')
+        variant_seqs = [v for v in attrs.get('Variant_seq', '').split(',') if v]
+        # Variant fields are built once per allele. Each sample row is a
+        # shallow copy, so all rows share the same field values.
+        wdict_blanks = {}
+        seq_idxs = {}
+        for seq_idx, alt in enumerate(variant_seqs):
+            if alt == ref_base or alt == '.' or alt in wdict_blanks:
+                continue
+            seq_idxs[alt] = seq_idx
+            wdict_blanks[alt] = {
                 "chrom": chrom_val,
                 "pos": pos_val,
                 'end_pos': end_pos,
-                "ref_base": "!",
-                "alt_base": "!",
-                "sample_id": sample,
+                "ref_base": ref_base,
+                "alt_base": alt,
             }
-            var_dicts.append(var_dict)
-            return var_dicts
\ No newline at end of file
+        for call in self.get_sample_calls(attrs, variant_seqs):
+            genotype = '/'.join(call['alleles']) if call['alleles'] else None
+            for alt in dict.fromkeys(call['alleles']):
+                if alt not in wdict_blanks:
+                    continue
+                alt_reads = None
+                if seq_idxs[alt] < len(call['variant_reads']):
+                    alt_reads = self.get_int(call['variant_reads'][seq_idxs[alt]])
+                tot_reads = call['tot_reads']
+                af = alt_reads / tot_reads if alt_reads is not None and tot_reads else None
+                var_dict = copy.copy(wdict_blanks[alt])
+                var_dict["sample"] = {
+                    "sample_id": call['sample_id'],
+                    "genotype": genotype,
+                    "zygosity": call['zygosity'],
+                    "tot_reads": tot_reads,
+                    "alt_reads": alt_reads,
+                    "af": af,
+                }
+                var_dicts.append(var_dict)
+        return var_dicts
@@ -0,0 +1,153 @@
+"""
+Measures the peak memory and the time per batch of parquet-converter's Arrow
+batch conversion, against the earlier path which read each page through
+duckdb's .df().to_dict('index').
+
+    python benchmark.py input.parquet [batch_size]
+
+Each path runs in its own process and reports its peak RSS, the peak of the
+Arrow memory pool, which tracemalloc does not see, and the largest
+tracemalloc peak of one batch. Reading, decoding and converting a batch are
+all measured.
+
+The input should have VCF-style columns (# [1]CHROM, [2]POS, [4]REF, [5]ALT).
+duckdb and pandas are needed only for the earlier path, which is skipped
+without them.
+"""
+import sys
+import json
+import time
+import resource
+import subprocess
+import tracemalloc
+import importlib.util
+from pathlib import Path
+
+
+def load_converter():
+    script_path = Path(__file__).parent / "parquet-converter.py"
+    spec = importlib.util.spec_from_file_location("parquet_converter", script_path)
+    if spec is None or spec.loader is None:
+        raise Exception(f"{script_path} could not be loaded.")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(next_batch) -> dict:
+    """
+    Calls next_batch, which reads, decodes and converts one batch, until it
+    returns None. Returns the largest tracemalloc peak over the memory in
+    use before each batch, the peak of the Arrow memory pool and the peak
+    RSS of the process, and the total time over batches.
+    """
+    import pyarrow as pa
+
+    peak = 0
+    count = 0
+    start = time.perf_counter()
+    tracemalloc.start()
+    while True:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        rows = next_batch()
+        if rows is None:
+            break
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        count += len(rows)
+        del rows
+    tracemalloc.stop()
+    return {
+        "rows": count,
+        "peak_mb": peak / 1024 / 1024,
+        "arrow_peak_mb": pa.default_memory_pool().max_memory() / 1024 / 1024,
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def arrow_batches(input_path: str, batch_size: int):
+    import pyarrow.dataset as ds
+
+    module = load_converter()
+    converter = module.Converter(module_options={})
+    dataset = ds.dataset(input_path, format="parquet")
+    converter.layout, converter.projection = converter.resolve_schema(dataset.schema)
+    batches = iter(dataset.to_batches(columns=converter.projection, batch_size=batch_size))
+    line_no = 1
+
+    def next_batch():
+        nonlocal line_no
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        rows = list(converter.convert_batch(batch, line_no))
+        line_no += batch.num_rows
+        return rows
+
+    return next_batch
+
+
+def dataframe_batches(input_path: str, batch_size: int):
+    import duckdb
+
+    conn = duckdb.connect()
+    num_rows = conn.execute(f"SELECT COUNT(*) FROM parquet_scan('{input_path}')").fetchone()[0]
+    start = 0
+
+    def next_batch():
+        nonlocal start
+        if start >= num_rows:
+            return None
+        page = conn.execute(
+            f"SELECT * FROM parquet_scan('{input_path}') LIMIT {batch_size} OFFSET {start}"
+        ).df().to_dict("index")
+        rows = []
+        for line_no, row in page.items():
+            rows.append((line_no + start, [{
+                "chrom": row["# [1]CHROM"],
+                "pos": row["[2]POS"],
+                "ref_base": row["[4]REF"],
+                "alt_base": row["[5]ALT"],
+            }]))
+        start += batch_size
+        return rows
+
+    return next_batch
+
+
+PATHS = {"arrow": arrow_batches, "dataframe": dataframe_batches}
+
+
+def run_path(name: str, input_path: str, batch_size: int):
+    try:
+        result = measure(PATHS[name](input_path, batch_size))
+    except ImportError as e:
+        result = {"error": str(e)}
+    print(json.dumps(result))
+
+
+def main():
+    input_path = sys.argv[1]
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    for name in PATHS:
+        output = subprocess.run(
+            [sys.executable, __file__, input_path, str(batch_size), name],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        if "error" in result:
+            print(f"{name}\tskipped: {result['error']}")
+            continue
+        print(
+            f"{name}\trows={result['rows']}\tpeak_per_batch={result['peak_mb']:.1f}MB"
+            f"\tarrow_peak={result['arrow_peak_mb']:.1f}MB\trss_peak={result['rss_peak_mb']:.1f}MB"
+            f"\tseconds={result['seconds']:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        run_path(sys.argv[3], sys.argv[1], int(sys.argv[2]))
+    else:
+        main()
@@ -1,19 +1,126 @@
-from typing import Tuple 
+from typing import Tuple
 from typing import List
 from typing import Dict
 from typing import Iterator
-import duckdb
-import pandas
+from typing import Optional
+from typing import Union
+import json
+import os
+import queue
+import multiprocessing
+import re
+from fnmatch import fnmatchcase
+from functools import reduce
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.dataset as ds
-import os,ntpath
 from oakvar import BaseConverter
 
+BATCH_SIZE = 65536
+# Seconds to wait for a converted row group before checking the worker processes.
+RESULT_TIMEOUT = 1
+VARIANT_FIELDS = ("chrom", "pos", "ref_base", "alt_base")
+# Column names of each variant field, by input layout, in the order they are
+# tried. Names are matched case-insensitively. "a.b" is field b of struct
+# column a, "a[0]" is the first element and "a[1:]" the rest of list column a.
+LAYOUTS = {
+    "parquetreporter": {
+        "chrom": ["base.chrom", "base__chrom"],
+        "pos": ["base.pos", "base__pos"],
+        "ref_base": ["base.ref_base", "base__ref_base"],
+        "alt_base": ["base.alt_base", "base__alt_base"],
+    },
+    "vcf": {
+        "chrom": ["# [1]CHROM", "#CHROM", "CHROM", "chrom", "chromosome"],
+        "pos": ["[2]POS", "POS", "pos", "position"],
+        "ref_base": ["[4]REF", "REF", "ref", "ref_base"],
+        "alt_base": ["[5]ALT", "ALT", "alt", "alt_base"],
+    },
+    "hail": {
+        "chrom": ["locus.contig"],
+        "pos": ["locus.position"],
+        "ref_base": ["alleles[0]"],
+        "alt_base": ["alleles[1:]"],
+    },
+}
+# Parquet key-value metadata with a JSON object of variant field to column
+# name, for producers which declare their layout.
+COLUMNS_METADATA_KEY = b"oakvar_columns"
+# Columns, including Hive partition keys such as sample=, giving the sample
+# of each row of a callset.
+SAMPLE_COLUMNS = ["sample", "sample_id"]
+# parquetreporter output has the samples of each variant joined by ";".
+REPORTER_SAMPLE_COLUMNS = ["tagsampler.samples", "tagsampler__samples", "base.samples", "base__samples"]
+# parquetreporter writes <prefix>_<chunk number>.parquet files.
+REPORTER_CHUNK_PATTERN = re.compile(r"^(.+)_(\d+)\.parquet$")
+# Genotype columns of wide callsets hold a VCF GT ("0/1", "1|1") or a whole
+# sample field ("0/1:35:..."). A carrier has a non-reference allele in GT.
+CARRIER_PATTERN = r"^[^:]*[1-9]"
+GT_SEPARATOR = re.compile(r"[/|]")
+# "[10]NA12878" style column names of VCF-derived tables.
+COLUMN_NUMBER_PREFIX = re.compile(r"^\[\d+\]")
+INT_FORMATS = {pa.int32(): "i", pa.int64(): "q", pa.uint32(): "I", pa.uint64(): "Q"}
+
+
+def iter_column(array: pa.Array):
+    """
+    Returns the values of an Arrow column as a sequence without a Python
+    copy of the whole column where possible. Integer columns without
+    nulls are read through a memoryview of their data buffer. String
+    columns are dictionary-encoded, so each distinct value becomes one
+    Python string shared by all its rows.
+    """
+    if array.null_count == 0:
+        if array.type in INT_FORMATS:
+            return memoryview(array.buffers()[1]).cast(INT_FORMATS[array.type])[
+                array.offset : array.offset + len(array)
+            ]
+        if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+            array = pc.dictionary_encode(array)
+        if pa.types.is_dictionary(array.type) and array.indices.null_count == 0:
+            values = array.dictionary.to_pylist()
+            return map(values.__getitem__, iter_column(array.indices))
+    return array.to_pylist()
+
+
+def get_field_expression(schema: pa.Schema, name: str) -> Optional[ds.Expression]:
+    """
+    Returns the scan expression of a column name in the notation of LAYOUTS,
+    or None if the schema does not have the column.
+    """
+    names = {v.lower(): v for v in schema.names}
+    if name.lower() in names:
+        return ds.field(names[name.lower()])
+    if name.endswith("[0]") or name.endswith("[1:]"):
+        base_name, _, index = name.rpartition("[")
+        base = get_field_expression(schema, base_name)
+        if base is None:
+            return None
+        if index == "0]":
+            return pc.list_element(base, 0)
+        return pc.list_slice(base, 1)
+    column, _, child = name.partition(".")
+    if child and column.lower() in names:
+        field_type = schema.field(names[column.lower()]).type
+        if pa.types.is_struct(field_type):
+            children = {field_type.field(i).name.lower(): field_type.field(i).name for i in range(field_type.num_fields)}
+            if child.lower() in children:
+                return ds.field(names[column.lower()], children[child.lower()])
+    return None
+
 
 class Converter(BaseConverter):
     def __init__(self, *args, **kwargs):
         super().__init__(*args,**kwargs)
         self.format_name = "parquet"
-        
+        self.layout: Optional[str] = None
+        self.projection: Dict[str, ds.Expression] = {}
+        self.sample_ids: List[str] = []
+        self.dataset: Optional[ds.Dataset] = None
+        self.rows: Optional[Iterator[Tuple[int, Union[List[Dict], Exception]]]] = None
+
     def check_format(self, f) -> bool:
         """
         Detect the format of an input file.
@@ -25,65 +132,462 @@ class Converter(BaseConverter):
         The example below checks if the input file's first line indicates
         VCF file format.
         """
-        if f.name.endswith('.parquet'):
-            return True 
-        if f.name.endswith('.parquet.gz'):
-            return True 
+        path = getattr(f, "name", f)
+        if os.path.isdir(path):
+            for _, _, filenames in os.walk(path):
+                if any(v.endswith(".parquet") for v in filenames):
+                    return True
+            return False
+        if path.endswith('.parquet'):
+            return True
+        if path.endswith('.parquet.gz'):
+            return True
         else: return False
-        
-
-    # If your converter module needs something else than
-    # the standard way of opening a text input file,
-    # read line by line, and coverting each line into
-    # a list of dictionaries of variants,
-    # you may want to start with modifying
-    # convert_file method. In that case, uncomment
-    # the below convert_file method and add your implementation.
-    def convert_file(
-        self, file, *__args__, exc_handler=None, input_path : str="", **__kwargs__
-    ) -> Iterator[Tuple[int, List[dict]]]:
-        
-        def file_name_acq(path) -> str:
-            head,tail = ntpath.split(path)
-            return tail or ntpath.basename(head)
-        
-        file_name = str(file_name_acq(input_path))
-        print(file_name)
-
-        conn = duckdb.connect()
-        row_q = 'row_group_num_rows'
-        rows = conn.execute(f'SELECT row_group_num_rows FROM parquet_metadata({file_name})').df().to_dict()
-        num_rows = rows[row_q][0]
-
-
-        start = 0
-        chunk = 1000
-        end = chunk
-        
-        #dataset = ds.dataset(file_name, format="parquet",partitioning="hive")
-        #conn.register(file_name, dataset)
-
-        
-        while start < num_rows:
-            QUERY = f'SELECT * FROM parquet_scan("{file_name}") LIMIT {chunk} OFFSET {start}'
-            count = conn.execute(QUERY).df().to_dict('index')
-            for variant in count:
-                count.update({variant+start:count[variant]})
-            for line_no in list(count.keys()):
+
+    def resolve_schema(self, schema: pa.Schema) -> Tuple[str, Dict[str, ds.Expression]]:
+        """
+        Maps the variant fields to the columns of a Parquet schema, once per
+        input. chrom_column, pos_column, ref_base_column and alt_base_column
+        module options come first, then the oakvar_columns key-value
+        metadata, then the first layout in LAYOUTS which has all the fields.
+        Returns the layout name and the projection of variant fields, which
+        puts chrom, pos, ref_base and alt_base at column indexes 0 to 3 of
+        each scanned batch, and sample_id at 4 if the input has a sample
+        column (sample_column module option).
+        """
+        declared: Dict[str, str] = {}
+        if schema.metadata and COLUMNS_METADATA_KEY in schema.metadata:
+            declared = json.loads(schema.metadata[COLUMNS_METADATA_KEY])
+        overrides = {
+            field: self.module_options.get(f"{field}_column") or declared.get(field)
+            for field in VARIANT_FIELDS
+        }
+        layout = "custom"
+        projection: Dict[str, ds.Expression] = {}
+        for field, name in overrides.items():
+            if not name:
+                continue
+            expr = get_field_expression(schema, name)
+            if expr is None:
+                raise Exception(f"Column {name} for {field} is not in the input.")
+            projection[field] = expr
+        if len(projection) < len(VARIANT_FIELDS):
+            for layout_name, names in LAYOUTS.items():
+                exprs = {}
+                for field in VARIANT_FIELDS:
+                    if field in projection:
+                        exprs[field] = projection[field]
+                        continue
+                    expr = next((e for e in [get_field_expression(schema, v) for v in names[field]] if e is not None), None)
+                    if expr is None:
+                        break
+                    exprs[field] = expr
+                if len(exprs) == len(VARIANT_FIELDS):
+                    layout = layout_name
+                    projection = exprs
+                    break
+            else:
+                missing = [v for v in VARIANT_FIELDS if v not in projection]
+                raise Exception(f"Columns for {', '.join(missing)} were not found. Use {missing[0]}_column module option.")
+        projection = {field: projection[field] for field in VARIANT_FIELDS}
+        genotype_columns = self.get_genotype_columns(schema, projection)
+        if genotype_columns:
+            self.sample_ids = [COLUMN_NUMBER_PREFIX.sub("", v) for v in genotype_columns]
+            for i, name in enumerate(genotype_columns):
+                projection[f"genotype_{i}"] = ds.field(name)
+            return layout, projection
+        sample_column = self.module_options.get("sample_column")
+        if sample_column:
+            sample_columns = {"sample_id": [sample_column]}
+        elif layout == "parquetreporter":
+            sample_columns = {"samples": REPORTER_SAMPLE_COLUMNS}
+        else:
+            sample_columns = {"sample_id": SAMPLE_COLUMNS}
+        for field, names in sample_columns.items():
+            for name in names:
+                expr = get_field_expression(schema, name)
+                if expr is not None:
+                    projection[field] = expr
+                    break
+        return layout, projection
+
+    def get_genotype_columns(self, schema: pa.Schema, projection: Dict[str, ds.Expression]) -> List[str]:
+        """
+        Returns the genotype columns of a wide callset, given by the
+        sample_columns module option as a list or a comma-separated string
+        of column names. Names with * or ? are matched as patterns against
+        the columns which are not variant fields.
+        """
+        sample_columns = self.module_options.get("sample_columns")
+        if not sample_columns:
+            return []
+        if isinstance(sample_columns, str):
+            sample_columns = sample_columns.split(",")
+        variant_columns = {
+            name for name in schema.names
+            if any(expr.equals(ds.field(name)) for expr in projection.values())
+        }
+        columns = []
+        for pattern in [v.strip() for v in sample_columns if v.strip()]:
+            if pattern in schema.names:
+                matches = [pattern]
+            elif "*" in pattern or "?" in pattern:
+                matches = [v for v in schema.names if fnmatchcase(v, pattern) and v not in variant_columns]
+            else:
+                raise Exception(f"Sample column {pattern} is not in the input.")
+            columns.extend(v for v in matches if v not in columns)
+        return columns
+
+    def setup(self, input_path: str, encoding: str = "utf-8"):
+        """
+        Opens the input and maps its columns. parquetreporter output is read
+        with all the chunk files of its run, and its positions are already
+        hg38, so no liftover is needed.
+        """
+        _ = encoding
+        self.dataset = self.open_dataset(input_path)
+        self.layout, self.projection = self.resolve_schema(self.dataset.schema)
+        if self.layout == "parquetreporter":
+            chunk_paths = self.get_reporter_chunk_paths(input_path)
+            if len(chunk_paths) > 1:
+                import pyarrow.parquet as pq
+
+                schema = pa.unify_schemas([pq.read_schema(v) for v in chunk_paths], promote_options="permissive")
+                self.dataset = ds.dataset(chunk_paths, format="parquet", schema=schema)
+            self.input_assembly = "hg38"
+
+    def get_reporter_chunk_paths(self, path: str) -> List[str]:
+        """
+        Returns the chunk files, <prefix>_<chunk number>.parquet, of the
+        parquetreporter run which wrote the chunk file at path, in chunk
+        order. Returns [path] if path is not a chunk file.
+        """
+        match = REPORTER_CHUNK_PATTERN.match(os.path.basename(path))
+        if os.path.isdir(path) or not match:
+            return [path]
+        prefix, chunk_no = match.groups()
+        pattern = re.compile(re.escape(prefix) + r"_\d{" + str(len(chunk_no)) + r"}\.parquet$")
+        dirname = os.path.dirname(path)
+        return [
+            os.path.join(dirname, v) for v in sorted(os.listdir(dirname or "."))
+            if pattern.match(v)
+        ]
+
+    def open_dataset(self, path: str) -> ds.Dataset:
+        """
+        Opens a Parquet file, or a directory of Parquet files with Hive
+        partitioning (chrom=chr1/sample=S1/...). Partition keys are read as
+        strings, so chrom=1 stays a chromosome name.
+        """
+        if not os.path.isdir(path):
+            return ds.dataset(path, format="parquet")
+        dataset = ds.dataset(path, format="parquet", partitioning="hive")
+        partitioning = getattr(dataset, "partitioning", None)
+        if partitioning is not None and len(partitioning.schema) > 0:
+            partition_schema = pa.schema([(v.name, pa.string()) for v in partitioning.schema])
+            dataset = ds.dataset(path, format="parquet", partitioning=ds.partitioning(partition_schema, flavor="hive"))
+        return dataset
+
+    def iter_batches(self, dataset: ds.Dataset, batch_size: int) -> Iterator[pa.RecordBatch]:
+        """
+        Scans the fragments (files) of a dataset in path order. Fragments
+        are decoded by a pool of workers (workers module option, the number
+        of CPUs by default) and their batches are yielded in path order, so
+        line numbers are the same across runs.
+        """
+        region_filter = self.get_region_filter()
+        fragments = sorted(dataset.get_fragments(filter=region_filter), key=lambda v: v.path)
+        workers = int(self.module_options.get("workers", os.cpu_count() or 1))
+
+        def scan(fragment):
+            return fragment.to_batches(
+                schema=dataset.schema, columns=self.projection, filter=region_filter, batch_size=batch_size
+            )
+
+        if workers <= 1 or len(fragments) <= 1:
+            for fragment in fragments:
+                yield from scan(fragment)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = deque()
+            for fragment in fragments:
+                futures.append(executor.submit(lambda v: list(scan(v)), fragment))
+                if len(futures) > workers:
+                    yield from futures.popleft().result()
+            while futures:
+                yield from futures.popleft().result()
+
+    def iter_converted_row_groups(
+        self, dataset: ds.Dataset, batch_size: int, processes: int
+    ) -> Iterator[Tuple[int, List[Tuple[int, Union[List[Dict], Exception]]]]]:
+        """
+        Converts the row groups of a dataset in a pool of forked worker
+        processes. Each worker decodes and converts whole row groups, and
+        the results are yielded in row-group order as (number of rows,
+        (line_no, variant dicts) with line numbers within the row group).
+        Rows which fail to convert have the exception instead of variant
+        dicts. Without regions, the number of rows is read from the row
+        group metadata, so a failure does not shift later line numbers.
+        At most two row groups per worker are in flight.
+        """
+        region_filter = self.get_region_filter()
+        row_groups = [
+            row_group
+            for fragment in sorted(dataset.get_fragments(filter=region_filter), key=lambda v: v.path)
+            for row_group in fragment.split_by_row_group(filter=region_filter)
+        ]
+        sizes = [None if region_filter is not None else v.row_groups[0].num_rows for v in row_groups]
+        context = multiprocessing.get_context("fork")
+        tasks = context.Queue()
+        results = context.Queue()
+
+        def work():
+            while True:
+                index = tasks.get()
+                if index is None:
+                    return
+                rows = []
+                num_rows = 0
                 try:
-                    yield line_no, self.convert_line(count[line_no])
+                    for batch in row_groups[index].to_batches(
+                        schema=dataset.schema, columns=self.projection, filter=region_filter, batch_size=batch_size
+                    ):
+                        rows.extend(self.iter_batch_rows(batch, num_rows + 1))
+                        num_rows += batch.num_rows
                 except Exception as e:
-                    if exc_handler:
-                        exc_handler(line_no,e)
-            start+= chunk
-            end+= chunk
-        return None
+                    # The rest of the row group could not be decoded. Its rows are error
+                    # lines, or one error line if their number is not known.
+                    end = num_rows + 1 if sizes[index] is None else sizes[index]
+                    rows.extend((line_no, e) for line_no in range(num_rows + 1, end + 1))
+                    num_rows = end
+                results.put((index, num_rows if sizes[index] is None else sizes[index], rows))
+
+        # Workers are forked, so they share row_groups and self without pickling.
+        workers = [context.Process(target=work, daemon=True) for _ in range(min(processes, len(row_groups)))]
+        for worker in workers:
+            worker.start()
+        try:
+            submitted = 0
+            for _ in range(2 * len(workers)):
+                if submitted < len(row_groups):
+                    tasks.put(submitted)
+                    submitted += 1
+            pending = {}
+            for next_index in range(len(row_groups)):
+                while next_index not in pending:
+                    try:
+                        index, num_rows, rows = results.get(timeout=RESULT_TIMEOUT)
+                    except queue.Empty:
+                        # Workers only exit when told to, so an exited worker has died.
+                        exitcodes = [v.exitcode for v in workers if v.exitcode is not None]
+                        if exitcodes:
+                            raise Exception(f"A parquet-converter worker process exited with code {exitcodes[0]}.")
+                        continue
+                    pending[index] = (num_rows, rows)
+                    if submitted < len(row_groups):
+                        tasks.put(submitted)
+                        submitted += 1
+                yield pending.pop(next_index)
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+    def get_region_filter(self) -> Optional[ds.Expression]:
+        """
+        Builds a filter expression from the regions module option, which is
+        a comma-separated list of chrom or chrom:start-end. The expression is
+        pushed down to the Parquet scan, so row groups whose min/max
+        statistics fall outside the regions are skipped.
+        """
+        regions = self.module_options.get("regions")
+        if not regions:
+            return None
+        if isinstance(regions, str):
+            regions = regions.split(",")
+        chrom_field = self.projection["chrom"]
+        pos_field = self.projection["pos"]
+        expr = None
+        for region in regions:
+            chrom, _, span = str(region).strip().partition(":")
+            if not chrom:
+                continue
+            chroms = [chrom, chrom[3:]] if chrom.startswith("chr") else [chrom, "chr" + chrom]
+            region_expr = chrom_field.isin(chroms)
+            if span:
+                start, _, end = span.replace(",", "").partition("-")
+                region_expr = region_expr & (pos_field >= int(start)) & (pos_field <= int(end or start))
+            expr = region_expr if expr is None else expr | region_expr
+        return expr
+
+    def iter_rows(self) -> Iterator[Tuple[int, Union[List[Dict], Exception]]]:
+        """
+        Streams the file or dataset once, row group by row group, in record
+        batches of batch_size rows (module option), and yields
+        (line_no, variant dicts) of each row. Line numbers are 1-based row
+        numbers over the files in path order, or over the rows in the
+        regions if the regions module option is given. With the processes
+        module option, row groups are converted in that many processes.
+        """
+        batch_size = int(self.module_options.get("batch_size", BATCH_SIZE))
+        processes = int(self.module_options.get("processes", 1))
+        dataset = self.dataset
+        line_no = 0
+        if processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+            for num_rows, rows in self.iter_converted_row_groups(dataset, batch_size, processes):
+                for row_line_no, var_dicts in rows:
+                    yield line_no + row_line_no, var_dicts
+                line_no += num_rows
+            return
+        # Only the mapped columns are decoded.
+        for batch in self.iter_batches(dataset, batch_size):
+            yield from self.iter_batch_rows(batch, line_no + 1)
+            line_no += batch.num_rows
+
+    def iter_batch_rows(self, batch: pa.RecordBatch, start_line_no: int) -> Iterator[Tuple[int, Union[List[Dict], Exception]]]:
+        """
+        Yields the rows of convert_batch. If the batch fails to convert, its
+        remaining rows are yielded with the exception instead, so that each
+        is counted as an error line.
+        """
+        next_line_no = start_line_no
+        try:
+            for line_no, var_dicts in self.convert_batch(batch, start_line_no):
+                yield line_no, var_dicts
+                next_line_no = line_no + 1
+        except Exception as e:
+            for line_no in range(next_line_no, start_line_no + batch.num_rows):
+                yield line_no, e
+
+    def get_variant_lines(
+        self, input_path: str, num_pool: int, start_line_no: int, batch_size: int
+    ) -> Tuple[Dict[int, List[Tuple[int, Union[List[Dict], Exception]]]], bool]:
+        """
+        Hands out the rows of iter_rows in num_pool chunks of batch_size.
+        Rows are converted from Arrow batches here, and convert_line of each
+        pool passes their variant dicts through.
+        """
+        from itertools import islice
+
+        if start_line_no == 1 or self.rows is None:
+            if self.dataset is None:
+                self.setup(input_path)
+            self.rows = self.iter_rows()
+        lines: Dict[int, List[Tuple[int, Union[List[Dict], Exception]]]] = {}
+        immature_exit = True
+        for chunk_no in range(num_pool):
+            lines[chunk_no] = list(islice(self.rows, batch_size)) if immature_exit else []
+            if len(lines[chunk_no]) < batch_size:
+                immature_exit = False
+        return lines, immature_exit
+
+    def convert_batch(self, batch: pa.RecordBatch, start_line_no: int) -> Iterator[Tuple[int, List[Dict]]]:
+        """
+        Converts a scanned batch, whose columns 0 to 3 are chrom, pos,
+        ref_base and alt_base and 4 is the optional sample_id (or samples,
+        joined by ";", of parquetreporter output), into
+        (line_no, variant dicts). A list-typed alt_base column gives one
+        variant per alternate allele. Columns are read from the Arrow
+        buffers, and rows are built straight into variant dicts.
+        """
+        if self.sample_ids:
+            yield from self.convert_callset_batch(batch, start_line_no)
+            return
+        chrom_column = batch.column(0)
+        if not pa.types.is_string(chrom_column.type):
+            chrom_column = chrom_column.cast(pa.string())
+        chroms = iter_column(chrom_column)
+        positions = iter_column(batch.column(1))
+        ref_bases = iter_column(batch.column(2))
+        alt_bases = iter_column(batch.column(3))
+        if batch.num_columns > 4 and batch.schema.field(4).name == "samples":
+            sample_lists = [(v or "").split(";") for v in iter_column(batch.column(4))]
+        elif batch.num_columns > 4:
+            sample_lists = [[v] for v in iter_column(batch.column(4))]
+        else:
+            sample_lists = [[None]] * batch.num_rows
+        line_nos = range(start_line_no, start_line_no + batch.num_rows)
+        if not pa.types.is_list(batch.schema.field(3).type) and batch.num_columns == 4:
+            for line_no, chrom, pos, ref_base, alt_base in zip(line_nos, chroms, positions, ref_bases, alt_bases):
+                yield line_no, [{"chrom": chrom, "pos": pos, "ref_base": ref_base, "alt_base": alt_base}]
+            return
+        alts_are_lists = pa.types.is_list(batch.schema.field(3).type)
+        for line_no, chrom, pos, ref_base, alts, sample_ids in zip(
+            line_nos, chroms, positions, ref_bases, alt_bases, sample_lists
+        ):
+            var_dicts = []
+            for alt_base in (alts or []) if alts_are_lists else [alts]:
+                for sample_id in sample_ids:
+                    var_dict = {"chrom": chrom, "pos": pos, "ref_base": ref_base, "alt_base": alt_base}
+                    if sample_id:
+                        var_dict["sample"] = {"sample_id": sample_id}
+                    var_dicts.append(var_dict)
+            yield line_no, var_dicts
+
+    def convert_callset_batch(self, batch: pa.RecordBatch, start_line_no: int) -> Iterator[Tuple[int, List[Dict]]]:
+        """
+        Converts a batch of a wide callset, whose columns from 4 on are the
+        genotypes of self.sample_ids. Carriers are found with Arrow compute
+        kernels, and only carrier genotypes and rows with a carrier are
+        read into Python. Each carrier gives one variant dict per alternate
+        allele in its genotype, with a sample dict.
+        """
+        genotype_columns = []
+        for i in range(4, batch.num_columns):
+            column = batch.column(i)
+            if not pa.types.is_string(column.type):
+                column = column.cast(pa.string())
+            genotype_columns.append(column)
+        carrier_masks = [
+            pc.fill_null(pc.match_substring_regex(v, CARRIER_PATTERN), False) for v in genotype_columns
+        ]
+        rows = pc.indices_nonzero(reduce(pc.or_, carrier_masks))
+        if len(rows) == 0:
+            return
+        calls: Dict[int, List[Tuple[str, str]]] = {}
+        for sample_id, column, carrier_mask in zip(self.sample_ids, genotype_columns, carrier_masks):
+            carriers = pc.indices_nonzero(carrier_mask)
+            for row, genotype in zip(iter_column(carriers), pc.take(column, carriers).to_pylist()):
+                calls.setdefault(row, []).append((sample_id, genotype))
+        variants = pa.RecordBatch.from_arrays([pc.take(batch.column(i), rows) for i in range(4)], names=list(VARIANT_FIELDS))
+        chrom_column = variants.column(0)
+        if not pa.types.is_string(chrom_column.type):
+            chrom_column = chrom_column.cast(pa.string())
+        alts_are_lists = pa.types.is_list(variants.schema.field(3).type)
+        for row, chrom, pos, ref_base, alts in zip(
+            iter_column(rows), iter_column(chrom_column), iter_column(variants.column(1)),
+            iter_column(variants.column(2)), iter_column(variants.column(3)),
+        ):
+            alts = (alts or []) if alts_are_lists else [alts]
+            var_dicts = []
+            for sample_id, genotype in calls[row]:
+                alleles = [v for v in GT_SEPARATOR.split(genotype.split(":", 1)[0]) if v not in (".", "")]
+                zygosity = "hom" if len(set(alleles)) == 1 else "het"
+                for allele in dict.fromkeys(alleles):
+                    if allele == "0" or not allele.isdigit() or int(allele) > len(alts):
+                        continue
+                    var_dicts.append({
+                        "chrom": chrom,
+                        "pos": pos,
+                        "ref_base": ref_base,
+                        "alt_base": alts[int(allele) - 1],
+                        "sample": {"sample_id": sample_id, "genotype": genotype, "zygosity": zygosity},
+                    })
+            yield start_line_no + row, var_dicts
 
     def convert_line(self, line) -> List[Dict]:
         """
         Converts a line from an input file to OakVar's variant dict.
         Arguments:
-            l: a string of a line from an input file
+            l: a dict of a row of an input file, keyed by variant field
+               (chrom, pos, ref_base, alt_base) as in the scan projection.
+               Rows of get_variant_lines are already variant dicts, which
+               are returned as they are, or the error of their batch,
+               which is raised.
         Returns:
             dict: a list of dicts, each dict for a variant collected
                   from the input line. Each dict should have
@@ -96,18 +600,21 @@ class Converter(BaseConverter):
                   sample_id: the ID or name of a sample having the variant [list[str]]
                   tags: a custom tag given to the variant [list[str]]
         """
+        if isinstance(line, Exception):
+            raise line
+        if isinstance(line, list):
+            return line
         current = line
+        alt_bases = current["alt_base"]
+        if not isinstance(alt_bases, list):
+            alt_bases = [alt_bases]
         var_dicts = []
-        var_dict = {
-        "chrom": "",
-        "pos": 0,
-        "ref_base": "",
-        "alt_base": ""
-        }
-        var_dict['chrom'] = current['# [1]CHROM']
-        var_dict['pos'] = current['[2]POS']
-        var_dict["ref_base"] = current['[4]REF']
-        var_dict["alt_base"] = current['[5]ALT']
-        var_dicts.append(var_dict)
-        var_dicts.append(var_dict)
+        for alt_base in alt_bases:
+            var_dict = {
+            "chrom": current["chrom"],
+            "pos": current["pos"],
+            "ref_base": current["ref_base"],
+            "alt_base": alt_base
+            }
+            var_dicts.append(var_dict)
         return var_dicts
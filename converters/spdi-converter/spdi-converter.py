@@ -1,51 +1,438 @@
 import re
+from array import array
+from functools import lru_cache
+from itertools import compress, islice
 from oakvar import BaseConverter
-from typing import Union, Dict
+from oakvar.lib.exceptions import IgnoredInput
+from typing import Any, Optional, Union, Dict, Iterator, List, Tuple
+
+# One pattern validates and splits a whole batch of lines. Lines which are not
+# SPDI fall through to the last group, so every line yields exactly one match.
+SPDI_LINE_PATTERN = re.compile(
+    r"^(?:([\w.]+):(\d+):([\w-]*):([\w-]*)|(.*?))\r?$", re.MULTILINE
+)
+SPDI_PATTERN = re.compile(r"^[\w.]+:\d+:[\w-]*:[\w-]*$")
+CHUNK_SIZE = 1 << 22
+WINDOW_SIZE = 1 << 12
+ACCESSION_PATTERN = re.compile(r"^[A-Z]{2}_\d+\.\d+$")
+ASSEMBLY_SCAN_LINES = 1000
+# Accessions are mapped with this assembly's table if the input's is unknown.
+DEFAULT_ASSEMBLY = "hg38"
+# Item of get_variant_lines for a line whose accession is not in the table
+UNMAPPED_ACCESSION = "spdi_unmapped_accession"
+
+
+@lru_cache(maxsize=None)
+def load_accession_maps() -> Dict[str, Dict[str, str]]:
+    """
+    Returns {assembly: {accession: chrom}} from refseq_accessions.tsv.
+    """
+    from pathlib import Path
+
+    maps: Dict[str, Dict[str, str]] = {}
+    with open(Path(__file__).parent / "refseq_accessions.tsv") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            assembly, accession, chrom = line.rstrip("\n").split("\t")
+            maps.setdefault(assembly, {})[accession] = chrom
+    return maps
+
+
+class SpdiBatch:
+    """
+    Parsed SPDI lines of one chunk of the input file, stored by column.
+    """
+
+    def __init__(self):
+        self.line_nos = array("q")
+        self.chroms: List[str] = []
+        self.positions = array("q")
+        self.ref_bases: List[str] = []
+        self.alt_bases: List[str] = []
+        self.invalid_lines: List[Tuple[int, str]] = []
+
+    def __len__(self):
+        return len(self.line_nos)
+
+    def to_arrays(self) -> Dict[str, Any]:
+        """
+        Returns the columns. line_no and pos are typed arrays ('q').
+        """
+        return {
+            "line_no": self.line_nos,
+            "chrom": self.chroms,
+            "pos": self.positions,
+            "ref_base": self.ref_bases,
+            "alt_base": self.alt_bases,
+        }
+
+    def select(self, mask: List[bool]):
+        self.line_nos = array("q", compress(self.line_nos, mask))
+        self.chroms = list(compress(self.chroms, mask))
+        self.positions = array("q", compress(self.positions, mask))
+        self.ref_bases = list(compress(self.ref_bases, mask))
+        self.alt_bases = list(compress(self.alt_bases, mask))
+
+    def to_var_dicts(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        for line_no, chrom, pos, ref_base, alt_base in zip(
+            self.line_nos, self.chroms, self.positions, self.ref_bases, self.alt_bases
+        ):
+            yield line_no, {
+                "var_no": line_no,
+                "chrom": chrom,
+                "pos": pos,
+                "ref_base": ref_base,
+                "alt_base": alt_base,
+            }
+
+
+class ReferenceWindows:
+    """
+    Reference bases fetched through the hg38wgs reader in windows of
+    window_size bases. Positions are 0-based. With positions visited in
+    sorted order, each window is fetched once.
+    """
+
+    def __init__(self, wgs_reader, window_size: int = WINDOW_SIZE, max_windows: int = 8):
+        self.wgs_reader = wgs_reader
+        self.window_size = window_size
+        self.max_windows = max_windows
+        self.chrom: Optional[str] = None
+        self.windows: Dict[int, str] = {}
+
+    def get_window(self, chrom: str, window_no: int) -> str:
+        if chrom != self.chrom:
+            self.chrom = chrom
+            self.windows = {}
+        window = self.windows.get(window_no)
+        if window is None:
+            start = window_no * self.window_size
+            window = self.wgs_reader.get_bases(chrom, start + 1, start + self.window_size, to_upper=True) or ""
+            if len(self.windows) >= self.max_windows:
+                del self.windows[min(self.windows)]
+            self.windows[window_no] = window
+        return window
+
+    def base(self, chrom: str, pos: int) -> str:
+        if pos < 0:
+            return ""
+        window_no, offset = divmod(pos, self.window_size)
+        window = self.get_window(chrom, window_no)
+        return window[offset] if offset < len(window) else ""
+
+    def bases(self, chrom: str, start: int, end: int) -> str:
+        """
+        Returns the bases of [start, end).
+        """
+        bases = []
+        while start < end:
+            window_no, offset = divmod(start, self.window_size)
+            window = self.get_window(chrom, window_no)
+            chunk = window[offset:offset + end - start]
+            if not chunk:
+                break
+            bases.append(chunk)
+            start += len(chunk)
+        return "".join(bases)
+
+
+def canonicalize_spdi(ref: ReferenceWindows, chrom: str, pos: int, deleted: str, inserted: str) -> Tuple[int, str, str]:
+    """
+    Expands an SPDI allele (0-based pos) to its full ambiguous span as in
+    NCBI VOCA. Insertions and deletions are rolled left and right over the
+    reference, and the deleted and inserted sequences are extended to cover
+    every position where the indel can be placed. Substitutions and alleles
+    which do not match the reference are returned trimmed.
+    """
+    # trim the common suffix and prefix
+    while deleted and inserted and deleted[-1] == inserted[-1]:
+        deleted, inserted = deleted[:-1], inserted[:-1]
+    while deleted and inserted and deleted[0] == inserted[0]:
+        deleted, inserted = deleted[1:], inserted[1:]
+        pos += 1
+    if (deleted and inserted) or not (deleted or inserted):
+        return pos, deleted, inserted
+    end = pos + len(deleted)
+    if deleted and ref.bases(chrom, pos, end) != deleted:
+        return pos, deleted, inserted
+    allele = deleted or inserted
+    left = pos
+    rolled = allele
+    while left > 0 and ref.base(chrom, left - 1) == rolled[-1]:
+        rolled = rolled[-1] + rolled[:-1]
+        left -= 1
+    right = end
+    rolled = allele
+    while ref.base(chrom, right) == rolled[0]:
+        rolled = rolled[1:] + rolled[0]
+        right += 1
+    if left == pos and right == end:
+        return pos, deleted, inserted
+    left_context = ref.bases(chrom, left, pos)
+    right_context = ref.bases(chrom, end, right)
+    return left, left_context + deleted + right_context, left_context + inserted + right_context
+
 
 class Converter(BaseConverter):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Currently var_no is not used in the SPDI format, but it is required by the BaseConverter class
-        # Therefore, we initialize it to 0 and increment it for each variant. Maybe another implementation later?
+        # Therefore, we count the lines given to convert_line, so that var_no is the 1-based
+        # line number, as it is for the lines parsed by get_variant_lines.
         self.index = 0
-        
+        self.items: Optional[Iterator[Tuple[int, Any]]] = None
+        self.accession_map: Dict[str, str] = {}
+        self.unmapped_accessions: Dict[str, int] = {}
+        self.reference: Optional[ReferenceWindows] = None
+
     def check_format(self, input_path) -> bool:
         """
         This function checks if the input file is in SPDI format and returns a boolean value.
         """
-        
-        pattern = re.compile(r'^\w+:\d+:[\w-]+:[\w-]+$')
-
         with open(input_path, 'r') as input_file:
             for line in input_file:
                 line = line.strip()
                 # Skip empty or comment lines
                 if not line or line.startswith("#"):
                     continue
-                
+
                 # Return True if the line matches the SPDI pattern, otherwise False
-                return bool(pattern.match(line))
-            
-    def convert_line(self, line: str) -> Union[Dict[str, Union[str, int]], None]:
+                return bool(SPDI_PATTERN.match(line))
+        return False
+
+    def setup(self, input_path: str, encoding: str = "utf-8"):
+        """
+        Loads the accession-to-chrom map of the input's genome assembly,
+        given by the assembly module option or detected from the first
+        RefSeq accession in the input. If neither gives an assembly, the
+        map of DEFAULT_ASSEMBLY is used.
+        """
+        maps = load_accession_maps()
+        assembly = self.module_options.get("assembly")
+        if assembly and assembly not in maps:
+            raise Exception(f"assembly should be one of {', '.join(maps)}, not {assembly}.")
+        if not assembly:
+            assembly = self.detect_assembly(input_path, maps, encoding=encoding)
+        if assembly:
+            self.input_assembly = assembly
+        self.accession_map = maps[assembly or DEFAULT_ASSEMBLY]
+        if self.get_standardized_module_option(self.module_options.get("canonicalize", False)) is True:
+            self.setup_reference(assembly or DEFAULT_ASSEMBLY)
+
+    @staticmethod
+    def detect_assembly(input_path: str, maps: Dict[str, Dict[str, str]], encoding: str = "utf-8") -> Optional[str]:
+        """
+        Returns the assembly of the first known accession in the first
+        ASSEMBLY_SCAN_LINES data lines. The scan stops at the first sequence
+        ID which is not an accession, such as chr1, which has no assembly.
+        """
+        with open(input_path, encoding=encoding) as f:
+            data_lines = (line for line in f if line.strip() and not line.startswith("#"))
+            for line in islice(data_lines, ASSEMBLY_SCAN_LINES):
+                seq_id = line.split(":", 1)[0].strip()
+                if not ACCESSION_PATTERN.match(seq_id):
+                    return None
+                assembly = next((k for k, v in maps.items() if seq_id in v), None)
+                if assembly:
+                    return assembly
+        return None
+
+    def setup_reference(self, assembly: str):
+        """
+        Canonicalization needs the reference genome of the input, which is
+        hg38 through the hg38wgs module.
+        """
+        import oakvar as ov
+
+        if assembly != "hg38":
+            raise Exception(f"canonicalize is supported for hg38 input only, not {assembly}.")
+        wgs_reader = ov.get_wgs_reader(assembly="hg38")
+        if wgs_reader is None:
+            raise Exception("canonicalize needs the hg38wgs module. Run `ov module install hg38wgs`.")
+        self.reference = ReferenceWindows(wgs_reader)
+
+    def canonicalize_batch(self, batch: SpdiBatch):
+        """
+        Canonicalizes the alleles of a batch in chrom and pos order, so that
+        neighboring variants share reference windows.
+        """
+        if not self.reference:
+            return
+        order = sorted(range(len(batch)), key=lambda i: (batch.chroms[i], batch.positions[i]))
+        for i in order:
+            batch.positions[i], batch.ref_bases[i], batch.alt_bases[i] = self.canonicalize(
+                batch.chroms[i], batch.positions[i], batch.ref_bases[i], batch.alt_bases[i]
+            )
+
+    def canonicalize(self, chrom: str, pos: int, ref_base: str, alt_base: str) -> Tuple[int, str, str]:
+        """
+        Canonicalizes one variant in 1-based pos and '-' notation.
+        """
+        if not self.reference:
+            return pos, ref_base, alt_base
+        deleted = "" if ref_base == "-" else ref_base.upper()
+        inserted = "" if alt_base == "-" else alt_base.upper()
+        pos0, deleted, inserted = canonicalize_spdi(self.reference, chrom, pos - 1, deleted, inserted)
+        return pos0 + 1, deleted or "-", inserted or "-"
+
+    def map_chrom(self, seq_id: str) -> Optional[str]:
+        """
+        Returns the chrom of a RefSeq accession, None if the accession is
+        not in the map, and other sequence IDs (chr1, 1) as they are.
+        """
+        chrom = self.accession_map.get(seq_id)
+        if chrom:
+            return chrom
+        if ACCESSION_PATTERN.match(seq_id):
+            self.unmapped_accessions[seq_id] = self.unmapped_accessions.get(seq_id, 0) + 1
+            return None
+        return seq_id
+
+    def map_batch_chroms(self, batch: SpdiBatch) -> List[int]:
+        """
+        Replaces accessions in batch.chroms with chroms, looking up each
+        distinct sequence ID once. Lines with unmapped accessions are removed
+        from the batch and their line numbers are returned.
+        """
+        chroms = {seq_id: self.accession_map.get(seq_id, seq_id) for seq_id in set(batch.chroms)}
+        unmapped = {seq_id for seq_id, chrom in chroms.items() if ACCESSION_PATTERN.match(chrom)}
+        ignored_line_nos: List[int] = []
+        if unmapped:
+            mask = [seq_id not in unmapped for seq_id in batch.chroms]
+            ignored_line_nos = list(compress(batch.line_nos, [not v for v in mask]))
+            for seq_id in batch.chroms:
+                if seq_id in unmapped:
+                    self.unmapped_accessions[seq_id] = self.unmapped_accessions.get(seq_id, 0) + 1
+            batch.select(mask)
+        batch.chroms = [chroms[seq_id] for seq_id in batch.chroms]
+        return ignored_line_nos
+
+    def log_unmapped_accessions(self):
+        """
+        Logs the number of lines of each accession which is not in the
+        accession map, whose lines are ignored.
+        """
+        from logging import getLogger
+
+        if not self.unmapped_accessions:
+            return
+        counts = ", ".join(f"{seq_id} ({n})" for seq_id, n in sorted(self.unmapped_accessions.items()))
+        getLogger("oakvar.converter").warning(
+            f"{sum(self.unmapped_accessions.values())} lines were ignored for accessions "
+            f"not in refseq_accessions.tsv: {counts}"
+        )
+
+    def iter_batches(self, input_path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[SpdiBatch]:
+        """
+        Memory-maps the input file and parses it in chunks of about
+        chunk_size bytes, cut at line ends. Line numbers are 1-based and
+        count every line of the file.
+        """
+        import mmap
+
+        with open(input_path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                return
+            with mm:
+                size = len(mm)
+                start = 0
+                line_no = 0
+                chroms: Dict[str, str] = {}
+                while start < size:
+                    end = mm.find(b"\n", min(start + chunk_size, size) - 1)
+                    if end == -1:
+                        end = size
+                    rows = SPDI_LINE_PATTERN.findall(mm[start:end].decode(errors="replace"))
+                    batch = SpdiBatch()
+                    batch.invalid_lines = [
+                        (i, row[4]) for i, row in enumerate(rows, line_no + 1)
+                        if not row[0] and row[4] and not row[4].startswith("#")
+                    ]
+                    valid = [row for row in rows if row[0]]
+                    if valid:
+                        batch.line_nos = array("q", [i for i, row in enumerate(rows, line_no + 1) if row[0]])
+                        batch.chroms = [chroms.setdefault(row[0], row[0]) for row in valid]
+                        batch.positions = array("q", [int(row[1]) + 1 for row in valid])
+                        batch.ref_bases = [row[2] or "-" for row in valid]
+                        batch.alt_bases = [row[3] or "-" for row in valid]
+                    line_no += len(rows)
+                    yield batch
+                    start = end + 1
+
+    def iter_items(self, input_path: str) -> Iterator[Tuple[int, Any]]:
+        """
+        Yields (line_no, item) in file order for get_variant_lines. The item
+        is [var_dict] for an SPDI line, UNMAPPED_ACCESSION for an unmapped
+        accession and the line itself if it is not SPDI, for convert_line to
+        report. The counts of unmapped accessions are logged at the end of
+        the file.
+        """
+        from heapq import merge
+        from operator import itemgetter
+
+        chunk_size = int(self.module_options.get("chunk_size", CHUNK_SIZE))
+        self.unmapped_accessions = {}
+        for batch in self.iter_batches(input_path, chunk_size=chunk_size):
+            ignored = [(line_no, UNMAPPED_ACCESSION) for line_no in self.map_batch_chroms(batch)]
+            self.canonicalize_batch(batch)
+            converted = [(line_no, [var_dict]) for line_no, var_dict in batch.to_var_dicts()]
+            yield from merge(batch.invalid_lines, ignored, converted, key=itemgetter(0))
+        self.log_unmapped_accessions()
+
+    def get_variant_lines(
+        self, input_path: str, num_pool: int, start_line_no: int, batch_size: int
+    ) -> Tuple[Dict[int, List[Tuple[int, Any]]], bool]:
+        """
+        Hands out the items of iter_items in num_pool chunks of batch_size.
+        The input is parsed in batches by this converter, and convert_line
+        of each pool passes the converted variants through.
+        """
+        if start_line_no == 1 or self.items is None:
+            self.items = self.iter_items(input_path)
+        lines: Dict[int, List[Tuple[int, Any]]] = {}
+        immature_exit = True
+        for chunk_no in range(num_pool):
+            lines[chunk_no] = list(islice(self.items, batch_size)) if immature_exit else []
+            if len(lines[chunk_no]) < batch_size:
+                immature_exit = False
+        return lines, immature_exit
+
+    def convert_line(self, line: Union[str, List[Dict[str, Any]]]) -> Union[List[Dict[str, Any]], str]:
         """
         This function converts a single line of SPDI format to a dictionary.
+        Items of get_variant_lines which are already converted are returned
+        as they are. Lines with an accession which is not in the accession
+        map raise IgnoredInput.
         """
-        parts = line.strip().split(':')
-        if len(parts) < 4:
-            return None  
-        
-        chrom, pos, ref_base, alt_base = parts
-        
+        if isinstance(line, list) or line == self.IGNORE:
+            return line
+        if line == UNMAPPED_ACCESSION:
+            raise IgnoredInput()
+        self.index += 1
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return self.IGNORE
+        if not SPDI_PATTERN.match(line):
+            raise Exception(f"{line} is not in SPDI format.")
+
+        seq_id, pos, ref_base, alt_base = line.split(':')
+        chrom = self.map_chrom(seq_id)
+        if chrom is None:
+            raise IgnoredInput()
+
         var_no = self.index
-        
+
+        pos, ref_base, alt_base = self.canonicalize(chrom, int(pos) + 1, ref_base or '-', alt_base or '-')
+
         var_dict = {
-            'var_no': var_no,  
+            'var_no': var_no,
             'chrom': chrom,
-            'pos': int(pos) + 1,
+            'pos': pos,
             'ref_base': ref_base,
             'alt_base': alt_base
         }
-        
-        self.index += 1  
-        
+
         return [var_dict]